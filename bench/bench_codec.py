@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+'''
+Per-call cost of the protocol codec: everything a command goes through on its way to the aircon, and a status reply
+on its way back to openhab.  Results are written as JSON, so runs from different versions can be compared.
+
+    python3 bench/bench_codec.py [--json codec.json] [--compare old.json]
+'''
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import types
+
+from Crypto.Cipher import AES   # pip3 install pycryptodome
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# main.py wants a settings module, but none of the functions benchmarked here use it
+sys.modules.setdefault('settings', types.ModuleType('settings'))
+
+import main as bridge
+import midea.crc8 as crc8
+from midea.cloud import VERSION
+from midea.cloud import async_cloud
+from midea.command import appliance_response
+from midea.command import base_command
+from midea.command import set_command
+from midea.packet_builder import packet_builder
+from midea.security import security
+
+APP_KEY = 'benchmark-app-key'
+DATA_KEY = b'0123456789abcdef'
+URL = async_cloud.SERVER_URL + 'appliance/transparent/send'
+
+# A status reply as it comes out of cloud.decode: 0x32 bytes of header, then the body appliance_response reads
+REPLY = bytearray(0x32) + bytearray.fromhex('c001486600000000000000646e2800000000000000000000')
+REPLY[0:2] = b'\x5a\x5a'
+
+# The fields device.update() reads from an appliance_response
+RESPONSE_FIELDS = ('power_state', 'target_temperature', 'operational_mode', 'fan_speed', 'swing_mode', 'eco_mode',
+                   'turbo_mode', 'indoor_temperature', 'outdoor_temperature', 'on_timer', 'off_timer', 'humidity')
+
+# What main.py pushes to openhab after a poll, and what comes back from it
+TO_OPENHAB = (('active', True), ('online', True), ('power_state', True), ('target_temperature', 24),
+              ('operational_mode', 2), ('fan_speed', 102), ('swing_mode', 0), ('eco_mode', False),
+              ('turbo_mode', False), ('indoor_temperature', 25.0), ('outdoor_temperature', 30.0))
+TO_MIDEA = (('power_state', 'ON'), ('target_temperature', '24.0'), ('operational_mode', '2'), ('fan_speed', '102'),
+            ('swing_mode', '0'), ('eco_mode', 'OFF'), ('turbo_mode', 'OFF'))
+OH_VALUES = ('24.5 °C', '40%', 'ON', 'NULL', '2')
+
+
+def access_token():
+    key_hash = hashlib.md5(APP_KEY.encode('ascii')).hexdigest().encode('ascii')[0:16]
+    return AES.new(key_hash, AES.MODE_ECB).encrypt(DATA_KEY + bytes([16] * 16)).hex()
+
+
+def cases():
+    """
+    name -> (callable, description).  Each callable does one of whatever it says.
+    """
+    cloud = async_cloud(APP_KEY, 'bench@example.com', 'bench')
+    codec = security(APP_KEY)
+    token = access_token()
+    codec.accessToken = token
+
+    command = set_command(0xAC)
+    command.target_temperature = 24
+    frame = command.finalize()
+    crc_data = bytes(frame[16:])
+
+    def build_packet():
+        builder = packet_builder()
+        builder.set_command(command)
+        return builder.finalize()
+
+    packet = build_packet()
+    encoded = cloud.encode(packet)
+    encrypted = codec.aes_encrypt(encoded)
+    payload = {'appId': 1017, 'format': 2, 'clientType': 1, 'language': 'en_US', 'src': 17,
+               'stamp': '20200101000000', 'applianceId': '1001', 'funId': '0000', 'order': encrypted.hex(),
+               'sessionId': '0123456789abcdef0123456789abcdef'}
+    encoded_reply = cloud.encode(REPLY)
+
+    def data_key_cold():
+        codec.accessToken = None    # throws away the cached key
+        codec.accessToken = token
+        return codec.data_key()
+
+    def decode_response():
+        response = appliance_response(REPLY)
+        return [getattr(response, field) for field in RESPONSE_FIELDS]
+
+    def to_openhab():
+        return [bridge.force_to_string(name, val) for name, val in TO_OPENHAB]
+
+    def to_midea():
+        return [bridge.force_to_midea(name, val) for name, val in TO_MIDEA]
+
+    def clean_oh_values():
+        return [bridge.clean_oh_value(val) for val in OH_VALUES]
+
+    return {
+        'crc8.calculate': (lambda: crc8.calculate(crc_data), '{} byte command body'.format(len(crc_data))),
+        'base_command.finalize': (lambda: base_command().finalize(), 'new status command, including its crc8'),
+        'packet_builder.finalize': (build_packet, 'new packet around a set command'),
+        'packet_builder.checksum': (lambda: packet_builder.checksum(None, frame[1:]), 'set command'),
+        'cloud.encode': (lambda: cloud.encode(packet), '{} byte packet'.format(len(packet))),
+        'cloud.decode': (lambda: cloud.decode(encoded_reply), '{} byte status reply'.format(len(REPLY))),
+        'security.sign': (lambda: codec.sign(URL, payload), 'appliance/transparent/send request'),
+        'security.aes_encrypt': (lambda: codec.aes_encrypt(encoded), '{} byte encoded packet'.format(len(encoded))),
+        'security.aes_decrypt': (lambda: codec.aes_decrypt(encrypted), '{} byte encrypted packet'.format(
+            len(encrypted))),
+        'security.data_key': (codec.data_key, 'after the first call'),
+        'security.data_key (new token)': (data_key_cold, 'first call after a login'),
+        'appliance_response': (decode_response, 'construct, and read the {} fields device.update() uses'.format(
+            len(RESPONSE_FIELDS))),
+        'main.force_to_string': (to_openhab, 'all {} properties sent to openhab'.format(len(TO_OPENHAB))),
+        'main.force_to_midea': (to_midea, 'all {} writable properties'.format(len(TO_MIDEA))),
+        'main.clean_oh_value': (clean_oh_values, '{} typical item states'.format(len(OH_VALUES))),
+    }
+
+
+def time_case(fn, repeat):
+    """
+    Best of `repeat` runs, each long enough (~0.2s) to time reliably.  Returns nanoseconds per call.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json', default='bench_codec.json', help='write the results here (default %(default)s)')
+    parser.add_argument('--compare', help='results from an earlier run, to show the change against')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', help='just these benchmarks')
+    args = parser.parse_args()
+
+    # importing main turns on debug logging; the codec shouldn't be timed writing log lines nobody sees
+    logging.getLogger().setLevel(logging.WARNING)
+
+    before = None
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)['results']
+
+    results = {}
+    for name, (fn, description) in cases().items():
+        if args.only and name not in args.only:
+            continue
+        ns = time_case(fn, args.repeat)
+        results[name] = {'ns_per_call': round(ns, 1), 'description': description}
+
+        line = '{:32} {:12.1f} ns'.format(name, ns)
+        if before and name in before:
+            line += '   {:6.2f}x'.format(before[name]['ns_per_call'] / ns)
+        print(line)
+
+    with open(args.json, 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results,
+        }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
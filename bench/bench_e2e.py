@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+End to end latency of main.py against bench/fake_cloud.py and a minimal fake openhab, at 1, 10 and 100 aircons:
+
+- poll cycle: one midea_to_openhab() over every aircon
+- event to apply: from an openhab command event being sent down the event stream, to the set command arriving at the
+    (fake) aircon
+
+    python3 bench/bench_e2e.py [--latency 0.1] [--units 1 10 100] [--json results.json]
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import types
+
+from aiohttp import web   # pip3 install aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_cloud import fake_cloud
+
+
+class fake_openhab:
+    """
+    Just enough of openhab's rest api for main.py: item states (one at a time, or all at once) and the event stream.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self._streams = []
+        self._loop = None
+        self.connects = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/rest/items', self._all_items)
+        app.router.add_get('/rest/items/{name}/state', self._get_state)
+        app.router.add_put('/rest/items/{name}/state', self._put_state)
+        app.router.add_get('/rest/events', self._events)
+        return app
+
+    async def _all_items(self, request):
+        return web.json_response([{'name': k, 'state': v} for k, v in self.items.items()])
+
+    async def _get_state(self, request):
+        name = request.match_info['name']
+        if name not in self.items:
+            raise web.HTTPNotFound()
+        return web.Response(text=self.items[name])
+
+    async def _put_state(self, request):
+        name = request.match_info['name']
+        if name not in self.items:
+            raise web.HTTPNotFound()
+        self.items[name] = await request.text()
+        return web.Response(status=202)
+
+    async def _events(self, request):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        self._streams.append(queue)
+        self.connects += 1
+        try:
+            while True:
+                await response.write(await queue.get())
+        except ConnectionError:
+            pass
+        finally:
+            self._streams.remove(queue)
+        return response
+
+    def command(self, item, value):
+        """
+        Send an ItemCommandEvent down every open event stream.
+        """
+        event = json.dumps({
+            'topic': 'openhab/items/{}/command'.format(item),
+            'payload': json.dumps({'type': 'Decimal', 'value': value}),
+            'type': 'ItemCommandEvent',
+        })
+        data = 'event: message\ndata: {}\n\n'.format(event).encode('utf-8')
+        for queue in list(self._streams):
+            self._loop.call_soon_threadsafe(queue.put_nowait, data)
+
+    def start(self, host='127.0.0.1', port=0):
+        self._loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self.app(), access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        self._loop.run_until_complete(site.start())
+        threading.Thread(target=self._loop.run_forever, name='Fake openhab', daemon=True).start()
+        return 'http://{}:{}'.format(host, runner.addresses[0][1])
+
+
+def make_settings(args):
+    settings = types.ModuleType('settings')
+    settings.APPKEY = 'fake-app-key'
+    settings.EMAIL = 'bench@example.com'
+    settings.PASSWORD = 'bench'
+    settings.AIRCONS = ()
+    settings.OH_URL = None
+    settings.MIDEA_SERVER_URL = None
+    settings.MIDEA_SESSION_CACHE = None
+    settings.MIDEA_POLL_FREQ_SECS = 365 * 24 * 60 * 60     # we do the polling
+    settings.MIDEA_POLL_WORKERS = args.workers
+    settings.MIDEA_POOL_SIZE = args.workers
+    settings.MIDEA_POLL_BUDGET_SECS = 300
+    settings.MIDEA_APPLY_WINDOW_SECS = args.window
+    settings.MIDEA_RATE_LIMIT = args.rate
+    settings.MIDEA_RATE_BURST = args.burst
+    settings.SSE_STALL_SECS = 0
+    return settings
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def summary(values):
+    return {
+        'median': statistics.median(values),
+        'p95': percentile(values, 95),
+        'max': max(values),
+    }
+
+
+def bench_units(main, settings, oh, units, args):
+    cloud = fake_cloud(units, args.latency, args.jitter)
+    settings.MIDEA_SERVER_URL = cloud.start()
+    settings.AIRCONS = tuple(a.name for a in cloud.aircons.values())
+    for aircon in settings.AIRCONS:
+        for prop in main.AC_RO_PROPERTIES + main.AC_RW_PROPERTIES:
+            oh.items['ac_{}_{}'.format(aircon, prop)] = 'NULL'
+
+    main.midea_init()
+    main.init_last_values()
+    main.oh_writes_init()
+
+    polls = []
+    for _ in range(args.polls):
+        start = time.monotonic()
+        main.midea_to_openhab()
+        polls.append(time.monotonic() - start)
+
+    connects = oh.connects
+    main.sse_init()
+    while oh.connects == connects:
+        time.sleep(0.01)
+
+    applies = []
+    aircons = list(cloud.aircons.values())
+    for _ in range(args.events):
+        aircon = random.choice(aircons)
+        value = 17 + (aircon.target_temperature - 16) % 14    # anything but what it is now
+        applied = aircon.applied
+        start = time.monotonic()
+        oh.command('ac_{}_target_temperature'.format(aircon.name), str(value))
+        while aircon.applied == applied:
+            if time.monotonic() - start > 30:
+                raise RuntimeError('{} never got the change'.format(aircon.name))
+            time.sleep(0.001)
+        applies.append(aircon.last_applied - start)
+
+    main.sse_stop()
+    main._client_inst.close()
+
+    return {
+        'units': units,
+        'poll_cycle_secs': summary(polls),
+        'event_to_apply_secs': summary(applies),
+        'cloud_calls': dict(cloud.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--units', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--latency', type=float, default=0.1, help='fake cloud response time, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='up to this much more, at random')
+    parser.add_argument('--workers', type=int, default=16, help='MIDEA_POLL_WORKERS')
+    parser.add_argument('--window', type=float, default=0.05, help='MIDEA_APPLY_WINDOW_SECS')
+    parser.add_argument('--rate', type=float, help='MIDEA_RATE_LIMIT (default: none)')
+    parser.add_argument('--burst', type=int, default=10, help='MIDEA_RATE_BURST')
+    parser.add_argument('--polls', type=int, default=5, help='poll cycles to time per fleet size')
+    parser.add_argument('--events', type=int, default=20, help='events to time per fleet size')
+    parser.add_argument('--json', help='also write the results here')
+    args = parser.parse_args()
+
+    settings = make_settings(args)
+    sys.modules['settings'] = settings
+    oh = fake_openhab()
+    settings.OH_URL = oh.start()
+
+    import main as bridge
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    print('fake cloud latency {:.3f}s (+{:.3f}s jitter), {} poll workers, {:.3f}s apply window'.format(
+        args.latency, args.jitter, args.workers, args.window))
+    print('{:>6} {:>14} {:>14} {:>16} {:>16}'.format('units', 'poll median', 'poll p95', 'event->apply med',
+                                                     'event->apply p95'))
+    for units in args.units:
+        result = bench_units(bridge, settings, oh, units, args)
+        results.append(result)
+        print('{:>6} {:>13.3f}s {:>13.3f}s {:>15.3f}s {:>15.3f}s'.format(
+            units, result['poll_cycle_secs']['median'], result['poll_cycle_secs']['p95'],
+            result['event_to_apply_secs']['median'], result['event_to_apply_secs']['p95']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+Per-message cost of midea.security's AES codec, compared against the old implementation (data key derived on every
+call, new zero IV CBC cipher for every 16 byte block).
+
+    python3 bench/bench_security.py
+'''
+import hashlib
+import os
+import sys
+import timeit
+
+from Crypto.Cipher import AES   # pip3 install pycryptodome
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from midea.security import INITIALIZATION_VECTOR
+from midea.security import security
+
+APP_KEY = 'benchmark-app-key'
+DATA_KEY = b'0123456789abcdef'
+
+# an encoded request is a few hundred bytes of csv
+MESSAGE = bytearray(b','.join([b'-86'] * 96))
+
+
+class legacy_security:
+    """
+    The codec as it was before the data key and cipher were cached.
+    """
+
+    def __init__(self, appKey, accessToken):
+        self.appKey = appKey
+        self.accessToken = accessToken
+        self.blockSize = 16
+
+    def aes_decrypt(self, raw, key=None):
+        if not key:
+            key = self.data_key()
+        final = bytearray([])
+        blocks = [raw[i:i + self.blockSize] for i in range(0, len(raw), self.blockSize)]
+        for block in blocks:
+            cipher = AES.new(key, AES.MODE_CBC, INITIALIZATION_VECTOR)
+            final.extend(cipher.decrypt(bytes(block)))
+        return bytes(final[:-final[-1]])
+
+    def aes_encrypt(self, raw, key=None):
+        if not key:
+            key = self.data_key()
+        pad = self.blockSize - (len(raw) % self.blockSize)
+        raw.extend([pad] * pad)
+        blocks = [raw[i:i + self.blockSize] for i in range(0, len(raw), self.blockSize)]
+        final = bytearray([])
+        for block in blocks:
+            cipher = AES.new(key, AES.MODE_CBC, INITIALIZATION_VECTOR)
+            final.extend(cipher.encrypt(bytes(block)))
+        return final
+
+    def data_key(self):
+        m = hashlib.md5()
+        m.update(self.appKey.encode('ascii'))
+        key_hash = m.hexdigest().encode('ascii')[0:16]
+        return self.aes_decrypt(bytearray.fromhex(self.accessToken), key_hash)
+
+
+def access_token():
+    key_hash = hashlib.md5(APP_KEY.encode('ascii')).hexdigest().encode('ascii')[0:16]
+    return AES.new(key_hash, AES.MODE_ECB).encrypt(DATA_KEY + bytes([16] * 16)).hex()
+
+
+def round_trip(codec):
+    # one request encrypted, one reply decrypted
+    encrypted = codec.aes_encrypt(bytearray(MESSAGE))
+    return codec.aes_decrypt(encrypted)
+
+
+def per_message_us(codec, number=5000, repeat=5):
+    return min(timeit.repeat(lambda: round_trip(codec), number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    token = access_token()
+    before = legacy_security(APP_KEY, token)
+    after = security(APP_KEY)
+    after.accessToken = token
+
+    assert round_trip(before) == round_trip(after) == bytes(MESSAGE)
+    assert before.aes_encrypt(bytearray(MESSAGE)) == after.aes_encrypt(bytearray(MESSAGE))
+
+    before_us = per_message_us(before)
+    after_us = per_message_us(after)
+    print('AES round trip, {} byte message'.format(len(MESSAGE)))
+    print('  before: {:8.2f} us/message'.format(before_us))
+    print('  after:  {:8.2f} us/message'.format(after_us))
+    print('  speedup: {:.1f}x'.format(before_us / after_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+'''
+A local stand-in for the midea cloud, for testing and benchmarking without the real thing.
+
+It speaks the same protocol as mapp.appsmb.com: requests are signed (and checked), appliance commands are AES
+encrypted with the data key from the access token, and the aircons it simulates keep their own state and answer with
+real appliance_response frames.  Latency and errors can be injected.
+
+    python3 bench/fake_cloud.py --units 10 --latency 0.1 --error 3123:0.05
+
+then point MIDEA_SERVER_URL (and APPKEY) in settings.py at it.
+'''
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from aiohttp import web   # pip3 install aiohttp
+from Crypto.Cipher import AES   # pip3 install pycryptodome
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from midea.security import security
+
+APP_KEY = 'fake-app-key'
+
+# Error codes the real cloud sends that the client has handling for
+INVALID_SESSION = 3106
+DEVICE_OFFLINE = 3123
+SYSTEM_ERROR = 9999
+# We made this one up.  The client doesn't know it, so it'll blow up loudly if it ever signs something wrong.
+BAD_SIGN = 3999
+
+
+def encode(data):
+    return bytearray(','.join(str(b - 256 if b >= 128 else b) for b in data).encode('ascii'))
+
+
+def decode(data):
+    return bytearray(int(b) & 0xff for b in data.decode('ascii').split(','))
+
+
+class fake_aircon:
+    """
+    One simulated aircon.  Set commands change its state, and every command is answered with its current status.
+    """
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.power_state = True
+        self.target_temperature = 24
+        self.operational_mode = 2      # cool
+        self.fan_speed = 102           # auto
+        self.swing_mode = 0
+        self.eco_mode = False
+        self.turbo_mode = False
+        self.indoor_temperature = 25.0
+        self.outdoor_temperature = 30.0
+        self.humidity = 40
+        self.online = True
+
+        self.applied = 0
+        self.last_applied = None    # time.monotonic() of the last set command
+
+    def detail(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'modelNumber': '0',
+            'sn': 'fake' + self.id,
+            'type': '0xAC',
+            'activeStatus': '1',
+            'onlineStatus': '1' if self.online else '0',
+        }
+
+    def handle(self, frame):
+        """
+        `frame` is a packet_builder packet.  Returns the reply frame.
+        """
+        command = frame[40:]
+        # A status request is the bare base_command template, a set_command always overwrites the 0xff fan speed
+        if command[0x0d] != 0xff:
+            self.power_state = (command[0x0b] & 0x01) > 0
+            self.target_temperature = (command[0x0c] & 0x0f) + 16
+            self.operational_mode = (command[0x0c] & 0xe0) >> 5
+            self.fan_speed = command[0x0d]
+            self.swing_mode = command[0x11] & 0x0f
+            self.eco_mode = command[0x13] > 0
+            self.turbo_mode = (command[0x14] & 0x02) > 0
+            self.applied += 1
+            self.last_applied = time.monotonic()
+        return self.status_frame()
+
+    def status_frame(self):
+        # The header is all noise as far as the client is concerned, so make it change every time like the real one
+        header = bytearray(os.urandom(0x32))
+        header[0:2] = b'\x5a\x5a'
+        body = bytearray(24)
+        body[0x00] = 0xc0
+        body[0x01] = 0x01 if self.power_state else 0
+        body[0x02] = ((self.operational_mode << 5) & 0xe0) | ((self.target_temperature - 16) & 0x0f)
+        body[0x03] = self.fan_speed & 0x7f
+        body[0x07] = self.swing_mode & 0x0f
+        body[0x09] = 0x10 if self.eco_mode else 0
+        body[0x0a] = 0x02 if self.turbo_mode else 0
+        body[0x0b] = int(self.indoor_temperature * 2 + 50) & 0xff
+        body[0x0c] = int(self.outdoor_temperature * 2 + 50) & 0xff
+        body[0x0d] = self.humidity & 0x7f
+        return header + body
+
+
+class fake_cloud:
+    """
+    :param units:       number of aircons, named Aircon1..AirconN.
+    :param latency:     seconds added to every response.
+    :param jitter:      up to this many more seconds, at random.
+    :param errors:      dict of error code -> probability of sending it in reply to an appliance request.
+        INVALID_SESSION also throws the session away, like the real thing.
+    """
+
+    def __init__(self, units=1, latency=0.0, jitter=0.0, errors=None, app_key=APP_KEY, password=None):
+        self.app_key = app_key
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(errors or {})
+
+        self.aircons = {}
+        for i in range(1, units + 1):
+            aircon = fake_aircon(str(1000 + i), 'Aircon{}'.format(i))
+            self.aircons[aircon.id] = aircon
+
+        # The data key never changes, only the session does
+        self.data_key = os.urandom(8).hex().encode('ascii')
+        self.security = security(app_key)
+        key_hash = hashlib.md5(app_key.encode('ascii')).hexdigest().encode('ascii')[0:16]
+        self.access_token = AES.new(key_hash, AES.MODE_ECB).encrypt(self.security._pad(self.data_key)).hex()
+        self.security.accessToken = self.access_token
+
+        self.sessions = set()
+        self.calls = {}     # endpoint -> count
+
+        self._handlers = {
+            'user/login/id/get': self._login_id,
+            'user/login': self._login,
+            'homegroup/list/get': self._homegroups,
+            'appliance/list/get': self._appliances,
+            'appliance/transparent/send': self._transparent_send,
+        }
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/v1/{endpoint:.+}', self._handle)
+        app.router.add_route('HEAD', '/v1/', self._ping)
+        return app
+
+    async def _ping(self, request):
+        return web.Response()
+
+    async def _handle(self, request):
+        endpoint = request.match_info['endpoint']
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        data = dict(await request.post())
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        handler = self._handlers.get(endpoint)
+        if handler is None:
+            return self._error(3000, 'unknown endpoint')
+
+        sign = data.pop('sign', None)
+        if sign != self.security.sign(str(request.url), data):
+            return self._error(BAD_SIGN, 'sign is illegal')
+
+        return handler(data)
+
+    def _result(self, result):
+        return web.json_response({'errorCode': '0', 'msg': 'ok', 'result': result})
+
+    def _error(self, code, msg):
+        return web.json_response({'errorCode': str(code), 'msg': msg})
+
+    def _check_session(self, data):
+        if data.get('sessionId') not in self.sessions:
+            return self._error(INVALID_SESSION, 'invalidSession')
+        return None
+
+    def _inject_error(self, data):
+        for code, probability in self.errors.items():
+            if random.random() < probability:
+                if code == INVALID_SESSION:
+                    self.sessions.discard(data['sessionId'])
+                return self._error(code, 'injected error')
+        return None
+
+    def _login_id(self, data):
+        return self._result({'loginId': uuid.uuid5(uuid.NAMESPACE_OID, data['loginAccount']).hex})
+
+    def _login(self, data):
+        if self.password is not None:
+            login_id = uuid.uuid5(uuid.NAMESPACE_OID, data['loginAccount']).hex
+            if data['password'] != self.security.encryptPassword(login_id, self.password):
+                return self._error(3102, 'password error')
+        session_id = uuid.uuid4().hex
+        self.sessions.add(session_id)
+        return self._result({'sessionId': session_id, 'userId': '1', 'accessToken': self.access_token})
+
+    def _homegroups(self, data):
+        return self._check_session(data) or self._result({'list': [{'id': '1', 'isDefault': '1', 'name': 'Home'}]})
+
+    def _appliances(self, data):
+        return self._check_session(data) or self._result({'list': [a.detail() for a in self.aircons.values()]})
+
+    def _transparent_send(self, data):
+        error = self._check_session(data) or self._inject_error(data)
+        if error is not None:
+            return error
+
+        aircon = self.aircons.get(data['applianceId'])
+        if aircon is None or not aircon.online:
+            return self._error(DEVICE_OFFLINE, 'device offline')
+
+        frame = decode(self.security.aes_decrypt(bytearray.fromhex(data['order'])))
+        reply = aircon.handle(frame)
+        return self._result({'reply': self.security.aes_encrypt(encode(reply)).hex()})
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serve from a background thread.  Returns the base url to use as MIDEA_SERVER_URL.
+        """
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self.app(), access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        port = runner.addresses[0][1]
+        threading.Thread(target=loop.run_forever, name='Fake cloud', daemon=True).start()
+        return 'http://{}:{}/v1/'.format(host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--units', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, at random')
+    parser.add_argument('--error', action='append', default=[], metavar='CODE:PROBABILITY',
+                        help='inject an error code into appliance requests, e.g. 3123:0.05')
+    parser.add_argument('--app-key', default=APP_KEY)
+    args = parser.parse_args()
+
+    errors = {}
+    for error in args.error:
+        code, probability = error.split(':')
+        errors[int(code)] = float(probability)
+
+    cloud = fake_cloud(args.units, args.latency, args.jitter, errors, args.app_key)
+    print('Fake midea cloud with {} aircons on http://{}:{}/v1/'.format(args.units, args.host, args.port))
+    web.run_app(cloud.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,34 @@ Created on 25 Jan 2019
 
 @author: dermot
 '''
+import asyncio
+import heapq
 import json
 import logging
+import multiprocessing
+import os
+import random
 import re
+import signal
+import sys
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from enum import Enum
 
+import aiohttp  # pip install aiohttp
 import requests
-import sseclient  # pip install sseclient
 
 import settings
+from midea import metrics
 from midea.client import client as midea_client
 from midea.cloud import DeviceOfflineException
 from midea.device import air_conditioning_device
+from midea.limiter import PRIORITY_APPLY
+from midea.limiter import PRIORITY_CONFIRM
+from midea.limiter import PRIORITY_POLL
 
 # our default logging level
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
@@ -32,26 +46,131 @@ _devices = None
 
 TEST_NO_MIDEA = False
 
+_oh_request_seconds = metrics.histogram('oh_request_seconds', 'Time taken by openhab rest requests', ('request',))
+_sse_received = metrics.counter('sse_events_received_total', 'Events received from the openhab event stream')
+_sse_dispatched = metrics.counter('sse_events_dispatched_total', 'Events from openhab passed on to a device')
+_sse_dropped = metrics.counter('sse_events_dropped_total', 'Events from openhab that were ignored')
+_sse_connects = metrics.counter('sse_connects_total', 'Connections made to the openhab event stream')
+_poll_cycle_seconds = metrics.histogram('midea_poll_cycle_seconds', 'Time taken to poll a batch of aircons')
+_poll_missed = metrics.counter('midea_poll_missed_total', 'Polls that did not finish within MIDEA_POLL_BUDGET_SECS',
+                               ('device',))
+
 
 def midea_init():
-    global _client_inst, _devices
+    global _client_inst
     if TEST_NO_MIDEA: return
-    _client_inst = midea_client(settings.APPKEY, settings.EMAIL, settings.PASSWORD)
-    _devices = _client_inst.devices()
+    if _client_inst is not None:
+        _client_inst.close()
+    _client_inst = midea_client(settings.APPKEY, settings.EMAIL, settings.PASSWORD,
+                                pool_size=getattr(settings, 'MIDEA_POOL_SIZE', 10),
+                                ping_secs=getattr(settings, 'MIDEA_KEEPALIVE_PING_SECS', 50),
+                                cache_file=getattr(settings, 'MIDEA_SESSION_CACHE', '.midea_session.json'),
+                                server_url=getattr(settings, 'MIDEA_SERVER_URL', None),
+                                rate_limit=getattr(settings, 'MIDEA_RATE_LIMIT', 5),
+                                rate_burst=getattr(settings, 'MIDEA_RATE_BURST', 10),
+                                offline_retry_secs=getattr(settings, 'MIDEA_OFFLINE_RETRY_SECS', 15),
+                                offline_retry_max_secs=getattr(settings, 'MIDEA_OFFLINE_RETRY_MAX_SECS', 300))
+    refresh_devices()
+
+
+def refresh_devices(max_age=None):
+    """
+    (Re)load the device list from midea, and rebuild the routes to match.
 
+    :param max_age: see client.devices
+    """
+    global _devices
+    _devices = _client_inst.devices(max_age)
+    build_routes()
+    if _scheduler is not None:
+        _scheduler.track([d.name for d in _devices
+                          if isinstance(d, air_conditioning_device) and d.name in settings.AIRCONS])
 
-# properties which only ever go from the midea -> oh
-AC_RO_PROPERTIES = ('active', 'online', 'indoor_temperature', 'outdoor_temperature',)  # 'humidity')
 
-# properties which can go in either direction
-AC_RW_PROPERTIES = ('power_state', 'target_temperature', 'operational_mode', 'fan_speed',
-                    'swing_mode', 'eco_mode', 'turbo_mode')
+_list_thread = None
+_list_lock = threading.Lock()
+
+
+def refresh_devices_soon(max_age):
+    """
+    Reload the device list from a background thread if it's more than `max_age` seconds old, so nobody has to wait
+    for it.  Does nothing if it's already being reloaded.
+    """
+    global _list_thread
+    if _client_inst is None or _client_inst.devices_age <= max_age:
+        return
+    with _list_lock:
+        if _list_thread is not None and _list_thread.is_alive():
+            return
+        _list_thread = threading.Thread(target=_refresh_devices_in_background, args=(max_age,), name='Device list',
+                                        daemon=True)
+        _list_thread.start()
+
+
+def _refresh_devices_in_background(max_age):
+    try:
+        logging.debug('Refreshing devices list')
+        refresh_devices(max_age)
+    except Exception:
+        logging.exception('Failed to refresh devices list')
+
+
+_routes = {}
+
+
+def build_routes():
+    """
+    Build the map of oh item name -> (device, property) for every property we accept from oh.  The new map replaces
+    the old one in one go, so readers only ever see a complete map.
+    """
+    global _routes
+    by_name = {d.name: d for d in (_devices or ())}
+    routes = {}
+    for aircon in settings.AIRCONS:
+        device = by_name.get(aircon)
+        if device is None:
+            logging.warning('Unable to locate device with name: {}'.format(aircon))
+            continue
+        for prop in AC_RW_PROPERTIES:
+            routes['ac_{}_{}'.format(aircon, prop)] = (device, prop)
+    _routes = routes
+
+
+RO = 'ro'   # only ever goes from midea -> oh
+RW = 'rw'   # can go in either direction
+
+# Every property we pass between midea and openhab.  The kind says how it looks on each side:
+#   'switch'    ON/OFF in oh, a bool in midea
+#   'number'    a float (always with a decimal) in oh, an int in midea
+#   an enum     its value as a float in oh, the enum in midea (it can be given by name from oh too)
+# Adding a property is just adding it here.
+AC_PROPERTIES = (
+    # name                  kind                                            direction
+    ('active',              'switch',                                       RO),
+    ('online',              'switch',                                       RO),
+    ('indoor_temperature',  'number',                                       RO),
+    ('outdoor_temperature', 'number',                                       RO),
+    # ('humidity',          'number',                                       RO),
+    ('power_state',         'switch',                                       RW),
+    ('target_temperature',  'number',                                       RW),
+    ('operational_mode',    air_conditioning_device.operational_mode_enum,  RW),
+    ('fan_speed',           air_conditioning_device.fan_speed_enum,         RW),
+    ('swing_mode',          air_conditioning_device.swing_mode_enum,        RW),
+    ('eco_mode',            'switch',                                       RW),
+    ('turbo_mode',          'switch',                                       RW),
+)
+
+AC_RO_PROPERTIES = tuple(name for name, kind, direction in AC_PROPERTIES if direction == RO)
+AC_RW_PROPERTIES = tuple(name for name, kind, direction in AC_PROPERTIES if direction == RW)
+
+_midea_properties = set(AC_RO_PROPERTIES + AC_RW_PROPERTIES)
 
 session = requests.Session()
 
 _last_oh_values = {}
 _last_midea_values = {}
-_stop_event = None
+# aircon -> (active, online, status_raw) of the device when update_from_midea last looked at it
+_last_midea_status = {}
 
 
 def init_last_values():
@@ -63,12 +182,15 @@ def init_last_values():
             _last_midea_values[aircon] = {k: 'NULL' for k in AC_RO_PROPERTIES + AC_RW_PROPERTIES}
 
 
-def update_from_openhab(aircon, ignore_nones=True):
+def update_from_openhab(aircon, ignore_nones=True, snapshot=None, skip=()):
     """
     Get the changes that have occurred in openhab since we last refreshed from there.
 
     :param aircon:
     :param ignore_nones:
+    :param snapshot:    dict of item name -> state, from get_oh_snapshot().  If None, each item is read from oh
+        separately.
+    :param skip:        item names to leave alone this time.
     :return dict    Returns a dict (may be empty) of properties that have changes along with their new values.
         e.g. {
             'power_state': 'ON',
@@ -81,7 +203,9 @@ def update_from_openhab(aircon, ignore_nones=True):
 
     # we only bother to pull in properties that could actually have changed on oh
     for prop in AC_RW_PROPERTIES:
-        new_val = get_oh_value('ac_{}_{}'.format(aircon, prop))
+        name = 'ac_{}_{}'.format(aircon, prop)
+        if name in skip: continue
+        new_val = get_oh_value(name) if snapshot is None else snapshot.get(name)
         if new_val is None and ignore_nones: continue
         if new_val != _last_oh_values[aircon][prop]:
             changed_values[prop] = new_val
@@ -94,9 +218,15 @@ def update_from_openhab(aircon, ignore_nones=True):
 def clean_oh_value(raw_val):
     if raw_val == 'NULL':
         return None
-    raw_val = re.sub('°C$', '', raw_val)
-    raw_val = re.sub('Â$', '', raw_val)
-    raw_val = re.sub('%$', '', raw_val)
+    # strip the units off the end (allowing for a newline after them)
+    if raw_val.endswith('\n'):
+        raw_val = raw_val[:-1]
+    if raw_val.endswith('°C'):
+        raw_val = raw_val[:-2]
+    if raw_val.endswith('Â'):
+        raw_val = raw_val[:-1]
+    if raw_val.endswith('%'):
+        raw_val = raw_val[:-1]
     return raw_val.strip()
 
 
@@ -109,7 +239,8 @@ def get_oh_value(name):
         return None
 
     url = settings.OH_URL + '/rest/items/' + name + '/state'
-    response = session.get(url)
+    response = session.get(url, timeout=getattr(settings, 'OH_TIMEOUT_SECS', 10))
+    _oh_request_seconds.observe(response.elapsed.total_seconds(), 'get')
     if response.ok:
         return clean_oh_value(response.text)
     elif response.status_code == 404:
@@ -119,17 +250,40 @@ def get_oh_value(name):
     return None
 
 
+def get_oh_snapshot():
+    """
+    Get the state of all our items (the ones starting ac_) from openhab in a single request.
+
+    :return dict    item name -> cleaned state, or None if openhab couldn't be read.
+    """
+    url = settings.OH_URL + '/rest/items'
+    response = session.get(url, params={'fields': 'name,state', 'recursive': 'false'},
+                           timeout=getattr(settings, 'OH_TIMEOUT_SECS', 10))
+    _oh_request_seconds.observe(response.elapsed.total_seconds(), 'get_all')
+    if not response.ok:
+        logging.warning('Unable to read items from OH: {} {}'.format(response.status_code, response.reason))
+        return None
+
+    return {item['name']: clean_oh_value(item.get('state', 'NULL'))
+            for item in response.json() if item.get('name', '').startswith('ac_')}
+
+
+_item_props = {}    # item name -> property name, as worked out by set_oh_value
+
+
 def set_oh_value(name, value):
+    """
+    :return     True if oh took it, False if it didn't, None if we didn't ask (it's blacklisted).
+    """
     # Don't bother to update blacklisted items (they're not there)
     if name in _blacklist_rest_items:
         return None
 
     # need to pull the property name from the rest name
-    matches = re.search(r"ac_[a-zA-Z\d]+_([\w]+)", name)
-    if matches:
-        prop_name = matches.group(1)
-    else:
-        prop_name = name
+    prop_name = _item_props.get(name)
+    if prop_name is None:
+        matches = re.search(r"ac_[a-zA-Z\d]+_([\w]+)", name)
+        prop_name = _item_props[name] = matches.group(1) if matches else name
 
     # oh values are always strings.  Make this one if it isn't already
     value = force_to_string(prop_name, value)
@@ -137,8 +291,9 @@ def set_oh_value(name, value):
     logging.debug('Setting OH: {} ({}) = {}'.format(name, prop_name, value))
 
     url = settings.OH_URL + '/rest/items/' + name + '/state'
-    response = session.put(url, data=value)
-    if response.ok:
+    response = session.put(url, data=value, timeout=getattr(settings, 'OH_TIMEOUT_SECS', 10))
+    _oh_request_seconds.observe(response.elapsed.total_seconds(), 'put')
+    if 200 <= response.status_code < 300:
         return True
     elif response.status_code == 404:
         logging.info('OH {} not found, blacklisting'.format(name))
@@ -147,75 +302,223 @@ def set_oh_value(name, value):
     return False
 
 
-# # properties which only ever go from the midea -> oh
-# AC_RO_PROPERTIES = ('active', 'online', 'indoor_temperature', 'outdoor_temperature')
-#
-# # properties which can go in either direction
-# AC_RW_PROPERTIES = ('power_state', 'target_temperature', 'operational_mode', 'fan_speed',
-#                     'swing_mode', 'eco_mode', 'turbo_mode')
+class oh_write_queue:
+    """
+    Writes to openhab, done by a small pool of worker threads so nothing else has to wait on openhab.
 
-def force_to_string(name, val):
-    if val is None or val == 'NULL':
-        return 'NULL'
+    Each item has at most one write pending.  If a newer value for an item arrives before the old one has been sent,
+    the old one is dropped.  Writes to the same item are never in flight at the same time, so they can't land out of
+    order.
+    """
 
-    # these are booleans - either 'ON' or 'OFF'
-    if name in {'active', 'online', 'power_state', 'eco_mode', 'turbo_mode'}:
-        if val in {1, 1.0, 'on', 'ON', '1', '1.0', True, 'y', 'Y'}:
-            return 'ON'
-        else:
-            return 'OFF'
+    def __init__(self, workers=2):
+        self._pending = OrderedDict()   # item name -> value, oldest first
+        self._in_flight = set()
+        self._done_at = {}              # item name -> time.monotonic() its last write finished
+        self._cond = threading.Condition()
+
+        self.dropped = 0        # writes replaced by a newer value before they were sent
+        self.sent = 0           # PUTs oh accepted
+        self.failed = 0         # PUTs that failed, or didn't get a 2xx back
+        self.skipped = 0        # writes to blacklisted items, which aren't sent at all
+        self.put_secs = 0.0     # total time spent in PUTs
+        self.put_max_secs = 0.0
+
+        for i in range(workers):
+            threading.Thread(target=self._run, name='OH writer {}'.format(i), daemon=True).start()
+
+    def put(self, name, value):
+        with self._cond:
+            if name in self._pending:
+                self.dropped += 1
+            self._pending[name] = value
+            self._cond.notify()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def touched_since(self, since):
+        """
+        Names of the items that have a write pending or in flight, or that finished a write after `since`
+        (time.monotonic()).  What oh reports for these can't be trusted to include our latest write.
+        """
+        with self._cond:
+            touched = set(self._pending) | self._in_flight
+            touched.update(name for name, done_at in self._done_at.items() if done_at >= since)
+            return touched
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._pending),
+                'in_flight': len(self._in_flight),
+                'dropped': self.dropped,
+                'sent': self.sent,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'put_mean_secs': self.put_secs / (self.sent + self.failed) if self.sent + self.failed else 0.0,
+                'put_max_secs': self.put_max_secs,
+            }
+
+    def _next(self):
+        # caller holds the lock
+        for name in self._pending:
+            if name not in self._in_flight:
+                return name, self._pending.pop(name)
+        return None
 
-    # these are floating point strings, always include a decimal
-    if name in {'indoor_temperature', 'outdoor_temperature', 'target_temperature', 'humidity'}:
-        return str(float(val))
+    def _run(self):
+        while True:
+            with self._cond:
+                item = self._next()
+                while item is None:
+                    self._cond.wait()
+                    item = self._next()
+                name, value = item
+                self._in_flight.add(name)
+
+            start = time.monotonic()
+            ok = False
+            try:
+                ok = set_oh_value(name, value)
+            except Exception:
+                logging.exception('Failed to set OH {} = {}'.format(name, value))
+            elapsed = time.monotonic() - start
+
+            with self._cond:
+                self._in_flight.discard(name)
+                self._done_at[name] = time.monotonic()
+                if ok is None:
+                    self.skipped += 1
+                else:
+                    if ok:
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+                    self.put_secs += elapsed
+                    self.put_max_secs = max(self.put_max_secs, elapsed)
+                # another worker may be waiting for this item to finish
+                self._cond.notify()
 
-    # these are enums.  We store them as their numeric value
-    if name in {'operational_mode', 'fan_speed', 'swing_mode'}:
-
-        enum_class = getattr(air_conditioning_device, name + '_enum')
-
-        if isinstance(val, Enum):
-            val_int = val.value
-        elif isinstance(val, (float, int)):
-            val_int = int(float(val))
-        elif val.replace('.', '', 1).isdigit():
-            # if it's a numeric string we just need to convert it to an int
-            val_int = int(float(val))
-        elif isinstance(val, str):
-            # any non-numeric string, just assume it's a string version of the enum
-            val_int = enum_class[val.lower()].value
-        else:
-            raise Exception('Unable to handle value "{}" for property "{}"'.format(val, name))
 
-        return str(float(enum_class(val_int).value))
+_oh_writes = None
 
 
-def force_to_midea(name, val):
-    # booleans
-    if name in {'power_state', 'eco_mode', 'turbo_mode'}:
-        if val is None: return False
+def oh_writes_init():
+    global _oh_writes
+    if _oh_writes is None:
+        _oh_writes = oh_write_queue(getattr(settings, 'OH_WRITE_WORKERS', 2))
+        metrics.gauge('oh_write_queue_depth', 'Writes to openhab waiting to be sent', lambda: _oh_writes.depth)
+        metrics.gauge('oh_write_queue_dropped_total', 'Writes to openhab replaced by a newer value before being sent',
+                      lambda: _oh_writes.dropped, kind='counter')
+        metrics.gauge('oh_write_queue_failed_total', 'Writes to openhab that failed',
+                      lambda: _oh_writes.failed, kind='counter')
+
+
+_ON_VALUES = {1, 1.0, 'on', 'ON', '1', '1.0', True, 'y', 'Y'}
+
+
+def _switch_converters():
+    def to_oh(val):
+        return 'ON' if val in _ON_VALUES else 'OFF'
+
+    def to_midea(val):
         return val == 'ON'
 
-    # ints
-    if name in {'target_temperature'}:
+    return to_oh, to_midea
+
+
+def _number_converters():
+    def to_oh(val):
+        return str(float(val))
+
+    def to_midea(val):
         return int(float(val))
 
-    if name == 'operational_mode':
-        if val.replace('.', '', 1).isdigit():
-            return air_conditioning_device.operational_mode_enum(int(float(val)))
-        return air_conditioning_device.operational_mode_enum[val.lower()]
+    return to_oh, to_midea
+
+
+def _enum_to_oh(enum_class, name, val):
+    if isinstance(val, Enum):
+        val_int = val.value
+    elif isinstance(val, (float, int)):
+        val_int = int(float(val))
+    elif val.replace('.', '', 1).isdigit():
+        # if it's a numeric string we just need to convert it to an int
+        val_int = int(float(val))
+    elif isinstance(val, str):
+        # any non-numeric string, just assume it's a string version of the enum
+        val_int = enum_class[val.lower()].value
+    else:
+        raise Exception('Unable to handle value "{}" for property "{}"'.format(val, name))
+
+    return str(float(enum_class(val_int).value))
+
+
+def _enum_to_midea(enum_class, val):
+    if val.replace('.', '', 1).isdigit():
+        return enum_class(int(float(val)))
+    return enum_class[val.lower()]
+
+
+def _enum_converters(enum_class, name):
+    # We store them as their numeric value.  Everything we expect to see is looked up; anything else goes the long
+    # way round, and fails the same way it always did.
+    to_oh_table = {}
+    to_midea_table = {}
+    for member in enum_class:
+        text = str(float(member.value))
+        keys = [str(member.value), text]
+        if member.name.islower():
+            keys.append(member.name)
+        for key in keys:
+            to_oh_table[key] = text
+            to_midea_table[key] = member
+        to_oh_table[member] = text
+        to_oh_table[member.value] = text
+
+    def to_oh(val):
+        text = to_oh_table.get(val)
+        return text if text is not None else _enum_to_oh(enum_class, name, val)
+
+    def to_midea(val):
+        member = to_midea_table.get(val)
+        return member if member is not None else _enum_to_midea(enum_class, val)
+
+    return to_oh, to_midea
+
+
+def _build_converters(properties):
+    to_oh = {}
+    to_midea = {}
+    for name, kind, direction in properties:
+        if kind == 'switch':
+            to_oh[name], from_oh = _switch_converters()
+        elif kind == 'number':
+            to_oh[name], from_oh = _number_converters()
+        else:
+            to_oh[name], from_oh = _enum_converters(kind, name)
+        if direction == RW:
+            to_midea[name] = from_oh
+    return to_oh, to_midea
+
+
+_to_oh, _to_midea = _build_converters(AC_PROPERTIES)
 
-    if name == 'fan_speed':
-        if val.replace('.', '', 1).isdigit():
-            return air_conditioning_device.fan_speed_enum(int(float(val)))
-        return air_conditioning_device.fan_speed_enum[val.lower()]
 
-    if name == 'swing_mode':
-        if val.replace('.', '', 1).isdigit():
-            return air_conditioning_device.swing_mode_enum(int(float(val)))
-        return air_conditioning_device.swing_mode_enum[val.lower()]
+def force_to_string(name, val):
+    if val is None or val == 'NULL':
+        return 'NULL'
+    to_oh = _to_oh.get(name)
+    return to_oh(val) if to_oh is not None else None
+
 
-    raise Exception('Cannot handle: {} with value {}'.format(name, val))
+def force_to_midea(name, val):
+    to_midea = _to_midea.get(name)
+    if to_midea is None:
+        raise Exception('Cannot handle: {} with value {}'.format(name, val))
+    return to_midea(val)
 
 
 def update_from_midea(device):
@@ -235,8 +538,21 @@ def update_from_midea(device):
     changed_values = {}
     aircon = device.name
 
-    # need to check all properties here
-    for prop in AC_RO_PROPERTIES + AC_RW_PROPERTIES:
+    # Usually the device is saying exactly what it said last time, and there's nothing to do
+    status = (device.active, device.online, device.status_raw)
+    last_status = _last_midea_status.get(aircon)
+    _last_midea_status[aircon] = status
+    if status[2] is None or last_status is None:
+        # need to check all properties here
+        props = AC_RO_PROPERTIES + AC_RW_PROPERTIES
+    elif status == last_status:
+        return changed_values
+    else:
+        # just the ones it's saying something different about
+        props = [prop for prop, val, last in zip(('active', 'online'), status, last_status) if val != last]
+        props += [prop for prop in device.changed_properties(last_status[2]) if prop in _midea_properties]
+
+    for prop in props:
         new_val = force_to_string(prop, getattr(device, prop))
         if new_val != _last_midea_values[aircon][prop]:
             changed_values[prop] = new_val
@@ -246,10 +562,59 @@ def update_from_midea(device):
     return changed_values
 
 
-def midea_to_openhab():
-    global _devices
-    if TEST_NO_MIDEA: return
+_poll_pool = None
+_polls_in_flight = set()    # names of devices with a poll still running
+_polls_lock = threading.Lock()
+
+
+def poll_device(device):
+    """
+    Refresh one device from midea, and send whatever changed to openhab.
+
+    :return bool    False if the device is offline.
+    """
+    try:
+        logging.debug('Refreshing {}'.format(device.name))
+        confirming = _scheduler is not None and _scheduler.confirming(device.name)
+        device.refresh(PRIORITY_CONFIRM if confirming else PRIORITY_POLL)
+
+        changes = update_from_midea(device)
+
+        # send each change to openhab
+        for k, v in changes.items():
+            _oh_writes.put('ac_{}_{}'.format(device.name, k), v)
+            _last_oh_values[device.name][k] = force_to_string(k, v)
+        return True
+    except DeviceOfflineException:
+        logging.warning('Device {} is offline, skipping midea->openhab run'.format(device.name))
+        return False
+    finally:
+        with _polls_lock:
+            _polls_in_flight.discard(device.name)
+
+
+def midea_to_openhab(names=None):
+    """
+    Poll our aircons at once (up to MIDEA_POLL_WORKERS at a time).  Anything that hasn't finished within
+    MIDEA_POLL_BUDGET_SECS is reported and left to finish in the background, rather than holding up the cycle.
+
+    :param names:   Names of the aircons to poll, or None for all of them.
+    :return dict    device -> True if it was polled, False if it's offline, None if we don't know (didn't finish in
+        time, failed, or was still busy with the last poll).
+    """
+    global _poll_pool
+    if TEST_NO_MIDEA: return {}
+    if _poll_pool is None:
+        _poll_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'MIDEA_POLL_WORKERS', 8),
+                                        thread_name_prefix='Poll')
+
+    start = time.monotonic()
+    futures = {}
+    results = {}
     for device in _devices:
+        if names is not None and device.name not in names:
+            continue
+
         if not isinstance(device, air_conditioning_device):
             logging.info('Skipping device, not an a/c: {}, {} {} {} {}'.format(device.name, device.model_number,
                                                                                device.serial_number, device.type))
@@ -259,181 +624,545 @@ def midea_to_openhab():
             logging.info('Skipping device {}, not one of ours'.format(device.name))
             continue
 
+        with _polls_lock:
+            if device.name in _polls_in_flight:
+                logging.warning('Last poll of {} still running, skipping it this time'.format(device.name))
+                results[device] = None
+                continue
+            _polls_in_flight.add(device.name)
+        futures[_poll_pool.submit(poll_device, device)] = device
+
+    done, not_done = wait(futures, timeout=getattr(settings, 'MIDEA_POLL_BUDGET_SECS', 60))
+
+    if not_done:
+        logging.warning('Poll cycle out of time, still waiting on: {}'.format(
+            ', '.join(sorted(futures[f].name for f in not_done))))
+        for f in not_done:
+            _poll_missed.inc(futures[f].name)
+
+    offline = False
+    error = None
+    for f in not_done:
+        results[futures[f]] = None
+    for f in done:
+        if f.exception() is not None:
+            logging.error('Failed to poll {}: {}'.format(futures[f].name, repr(f.exception())))
+            error = error or f.exception()
+            results[futures[f]] = None
+        else:
+            results[futures[f]] = f.result()
+            offline = offline or not f.result()
+
+    elapsed = time.monotonic() - start
+    _poll_cycle_seconds.observe(elapsed)
+    logging.debug('Poll cycle of {} devices took {:.2f}s'.format(len(futures), elapsed))
+    logging.debug('Midea request timings: {}'.format(_client_inst.stats()))
+    logging.debug('Midea rate limiter waits: {}'.format(_client_inst.queue_stats()))
+    logging.debug('OH write queue: {}'.format(_oh_writes.stats()))
+
+    if offline:
+        # the list says which devices are online, but a device that keeps dropping out shouldn't have us fetching it
+        # every time
+        refresh_devices_soon(getattr(settings, 'MIDEA_DEVICE_LIST_MIN_AGE_SECS', 60))
+
+    if error is not None:
+        raise error
+
+    return results
+
+
+class poll_scheduler:
+    """
+    Keeps track of when each aircon is next due a poll, rather than polling them all every MIDEA_POLL_FREQ_SECS:
+
+    - an aircon that's on is polled every MIDEA_POLL_FREQ_SECS
+    - one that's off is polled every MIDEA_IDLE_POLL_SECS (or MIDEA_POLL_FREQ_SECS, if that's longer)
+    - after we've changed something, it's polled every MIDEA_CONFIRM_POLL_SECS for MIDEA_CONFIRM_WINDOW_SECS, to
+        make sure the change took.  A window of 0 turns this off.
+    - if it's offline, it's polled as soon as the cloud will let anything through to it again, so the poll is what
+        finds out that it's back (see MIDEA_OFFLINE_RETRY_SECS)
+
+    Every interval gets +/-10% of jitter, and the first round after startup is spread over the whole interval, so the
+    polls don't bunch up.  An aircon that turns up later (in a new device list) gets the same treatment.
+    """
+
+    JITTER = 0.1
+    RETRY_SECS = 30     # when a poll didn't get as far as telling us how it went
+    OFFLINE_MARGIN_SECS = 1
+
+    def __init__(self):
+        self._heap = []             # (due, seq, name).  Entries that don't match _due are stale, and skipped.
+        self._due = {}              # name -> time.monotonic() it's next due
+        self._busy = set()          # names handed out by wait_due() that haven't been polled() or retry()ed yet
+        self._seq = 0
+        self._confirm_until = {}    # name -> end of the fast polling after an apply
+        self._cond = threading.Condition()
+
+        self.poll_secs = settings.MIDEA_POLL_FREQ_SECS
+        self.idle_secs = getattr(settings, 'MIDEA_IDLE_POLL_SECS', self.poll_secs * 4)
+        self.confirm_secs = getattr(settings, 'MIDEA_CONFIRM_POLL_SECS', 15)
+        self.confirm_window_secs = getattr(settings, 'MIDEA_CONFIRM_WINDOW_SECS', 60)
+
+    def _schedule(self, name, due):
+        # caller holds the lock
+        self._due[name] = due
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, name))
+        self._cond.notify()
+
+    def _interval(self, device, result, now):
+        name = device.name
+        if result is False:
+            return device.offline_retry_secs
+        if self._confirm_until.get(name, 0) > now:
+            return self.confirm_secs
+        if result and not device.power_state:
+            return max(self.idle_secs, self.poll_secs)     # never more often than one that's on
+        return self.poll_secs
+
+    def polled(self, results, first=False):
+        """
+        Schedule the next poll for each device, from the results of midea_to_openhab().
+        """
+        now = time.monotonic()
+        with self._cond:
+            for device, result in results.items():
+                self._busy.discard(device.name)
+                interval = self._interval(device, result, now)
+                if first:
+                    interval *= random.uniform(0.5, 1.0)
+                else:
+                    interval *= random.uniform(1 - self.JITTER, 1 + self.JITTER)
+                if result is False:
+                    # jitter that got in before the cloud will try it would only find out what we already know
+                    interval = max(interval, device.offline_retry_secs + self.OFFLINE_MARGIN_SECS)
+                self._schedule(device.name, now + interval)
+
+    def track(self, names):
+        """
+        Make sure all of `names` are going to be polled, e.g. after the device list has changed.
+        """
+        now = time.monotonic()
+        with self._cond:
+            for name in names:
+                if name not in self._due and name not in self._busy:
+                    self._schedule(name, now + self.poll_secs * random.uniform(0, 0.5))
+
+    def retry(self, names):
+        """
+        Poll `names` again soon.  For ones that were due, but didn't get polled.
+        """
+        now = time.monotonic()
+        with self._cond:
+            for name in names:
+                self._busy.discard(name)
+                self._schedule(name, now + self.RETRY_SECS * random.uniform(1 - self.JITTER, 1 + self.JITTER))
+
+    def applied(self, name):
+        """
+        We've just sent a change to `name`, so keep a closer eye on it for a while (unless MIDEA_CONFIRM_WINDOW_SECS
+        is 0).
+        """
+        if self.confirm_window_secs <= 0:
+            return
+        now = time.monotonic()
+        with self._cond:
+            self._confirm_until[name] = now + self.confirm_window_secs
+            if self._due.get(name, float('inf')) > now + self.confirm_secs:
+                self._schedule(name, now + self.confirm_secs)
+
+    def confirming(self, name):
+        """
+        True if we're still checking that a change to `name` took.
+        """
+        return self._confirm_until.get(name, 0) > time.monotonic()
+
+    def wait_due(self, timeout=1.0):
+        """
+        Wait (up to `timeout` seconds) for devices to come due.
+
+        :return list    names of the devices that are due now (may be empty).
+        """
+        with self._cond:
+            now = time.monotonic()
+            if not self._heap or self._heap[0][0] > now:
+                wait_secs = timeout if not self._heap else min(timeout, self._heap[0][0] - now)
+                self._cond.wait(wait_secs)
+                now = time.monotonic()
+
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                when, _, name = heapq.heappop(self._heap)
+                if self._due.get(name) == when:
+                    del self._due[name]
+                    self._busy.add(name)
+                    due.append(name)
+            return due
+
+
+_scheduler = None
+
+
+class device_actor:
+    """
+    Mailbox for changes headed to one device.  Changes are posted here (from the sse thread or wherever) and a worker
+    thread sends them on to midea.  When the first change arrives, the worker waits `window` seconds to collect any
+    others, then sends everything in a single apply, so a scene that sets power, mode, temperature and fan is one
+    refresh and one apply rather than four of each.
+
+    The refresh is skipped if the device state is less than `max_state_age` seconds old.
+    """
+
+    def __init__(self, device, window, max_state_age=0):
+        self.device = device
+        self.window = window
+        self.max_state_age = max_state_age
+        self._pending = {}      # prop -> cleaned oh value, newest wins
+        self._cond = threading.Condition()
+        self._stopped = False
+        threading.Thread(target=self._run, name='Actor ' + device.name, daemon=True).start()
+
+    def post(self, prop, value):
+        """
+        Queue a change of `prop` to `value` (a cleaned oh value).  Doesn't wait for it to be sent.
+        """
+        str_val = force_to_string(prop, value)
+        with self._cond:
+            # only need to send to midea if something has changed (or to overwrite something that's pending)
+            if prop not in self._pending and _last_midea_values.get(self.device.name, {}).get(prop) == str_val:
+                return
+            self._pending[prop] = value
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+            # give the rest of the burst a chance to arrive
+            time.sleep(self.window)
+
+            with self._cond:
+                changes, self._pending = self._pending, {}
+
+            try:
+                self._apply(changes)
+            except Exception:
+                logging.exception('Failed to apply changes to {}: {}'.format(self.device.name, changes))
+
+    def _apply(self, changes):
+        device = self.device
+        last_values = _last_midea_values[device.name]
+
+        # drop anything that ended up back where it started, and anything we can't make sense of (without losing the
+        # rest of the batch with it)
+        converted = {}  # prop -> (midea value, oh string)
+        for k, v in changes.items():
+            try:
+                str_val = force_to_string(k, v)
+                if str_val != last_values.get(k):
+                    converted[k] = (force_to_midea(k, v), str_val)
+            except Exception as e:
+                logging.warning('Ignoring {} = {} for {}: {}'.format(k, v, device.name, repr(e)))
+        if not converted:
+            return
+
+        # last_values is about to stop saying what the device last told us, so the next poll mustn't skip comparing
+        # against it, even if the same status comes back (say because this all fails)
+        _last_midea_status.pop(device.name, None)
+        previous = {k: last_values.get(k) for k in converted}
+
         try:
-            logging.debug('Refreshing {}'.format(device.name))
-            device.refresh()
+            # make sure that what we have is current, unless we heard from the device recently enough to trust it
+            if device.state_age > self.max_state_age:
+                device.refresh(PRIORITY_APPLY)     # someone's waiting on this, so it's as urgent as the apply
+
+            for k, (midea_val, str_val) in converted.items():
+                logging.debug('Push to Midea {}: {} = {}'.format(device.name, k, midea_val))
+                setattr(device, k, midea_val)
+                last_values[k] = str_val
+
+            device.apply()
+            if _scheduler is not None:
+                _scheduler.applied(device.name)
+        except DeviceOfflineException as e:
+            logging.warning('Device {} is offline, not updating settings: {}'.format(device.name, e))
+            last_values.update(previous)
+            refresh_devices_soon(getattr(settings, 'MIDEA_DEVICE_LIST_MIN_AGE_SECS', 60))
+        except Exception:
+            # it didn't go, so don't let post() think it did
+            last_values.update(previous)
+            raise
+
 
-            changes = update_from_midea(device)
+_actors = {}
+_actors_lock = threading.Lock()
 
-            # send each change to openhab
-            for k, v in changes.items():
-                set_oh_value('ac_{}_{}'.format(device.name, k), v)
-                _last_oh_values[device.name][k] = force_to_string(k, v)
-        except DeviceOfflineException:
-            logging.warning(
-                'Device {} is offline, skipping midea->openhab run, and refreshing devices list'.format(device.name))
-            _devices = _client_inst.devices()
+
+def get_actor(device):
+    """
+    The actor for `device`, created on first use (or if the device has been rebuilt by a new client).
+    """
+    with _actors_lock:
+        actor = _actors.get(device.name)
+        if actor is None or actor.device is not device:
+            if actor is not None:
+                actor.stop()
+            actor = device_actor(device, getattr(settings, 'MIDEA_APPLY_WINDOW_SECS', 0.5),
+                                 getattr(settings, 'MIDEA_STATE_MAX_AGE_SECS', 60))
+            _actors[device.name] = actor
+        return actor
 
 
 def openhab_to_midea():
-    global _devices
+    started = time.monotonic()
+
+    # one request for everything, falling back to an item at a time if that doesn't work
+    snapshot = get_oh_snapshot()
+
+    # if we've written to an item while reading oh, what oh told us may be older than what we wrote
+    skip = _oh_writes.touched_since(started) if _oh_writes is not None else set()
+
     for aircon in settings.AIRCONS:
-        changes = update_from_openhab(aircon)
+        changes = update_from_openhab(aircon, snapshot=snapshot, skip=skip)
 
-        if changes:
+        for k, v in changes.items():
+            route = _routes.get('ac_{}_{}'.format(aircon, k))
+            if route is None:
+                continue    # device isn't there at the moment
+            get_actor(route[0]).post(k, v)
 
-            device = None
-            for d in _devices:
-                if d.name == aircon:
-                    device = d
-                    break
 
-            if device is None:
-                raise Exception('Unable to locate device with name: ' + aircon)
+# Only ask oh for events on our items.  `*` matches across slashes, so the last one also covers group events
+# (.../items/<group>/<member>/statechanged).  The topic prefix is 'smarthome' on oh2 and 'openhab' on oh3.
+SSE_TOPICS = '*/items/ac_*/state,*/items/ac_*/command,*/items/ac_*/statechanged'
+# A shard subscribes to just its own aircons, unless there are so many that the url would get silly
+SSE_SHARD_TOPICS_MAX_AIRCONS = 20
 
-            try:
-                # make sure that what we have is current
-                device.refresh()
 
-                for k, v in changes.items():
-                    logging.debug('Push to Midea {}: {} = {}'.format(aircon, k, v))
-                    setattr(device, k, force_to_midea(k, v))
-                    _last_midea_values[device.name][k] = force_to_string(k, v)
+def sse_topics():
+    if _shard is None or len(settings.AIRCONS) > SSE_SHARD_TOPICS_MAX_AIRCONS:
+        return SSE_TOPICS
+    return ','.join('*/items/ac_{}_*/{}'.format(aircon, kind) for aircon in settings.AIRCONS
+                    for kind in ('state', 'command', 'statechanged'))
 
-                device.apply()
-            except DeviceOfflineException:
-                logging.warning(
-                    'Device {} is offline, not updating settings, and refreshing devices list'.format(device.name))
-                _devices = _client_inst.devices()
+# Events we act on.  Anything else is thrown away before any json is parsed.
+SSE_EVENT_TYPES = frozenset(('ItemStateChangedEvent', 'ItemStateEvent', 'GroupItemStateChangedEvent',
+                             'ItemCommandEvent'))
 
+# Inside the payload every quote is escaped, so these only ever match the envelope's own fields
+_sse_type_re = re.compile(r'"type"\s*:\s*"(\w+)"')
+_sse_topic_re = re.compile(r'"topic"\s*:\s*"([^"]*)"')
+_sse_payload_re = re.compile(r'"payload"\s*:\s*(?=")')
+_json_decoder = json.JSONDecoder()
 
-def sse_init():
-    global _stop_event, _devices
 
-    # Looks like sseclient doesn't have a way of forcing a client disconnect, so the stop event here is a bit
-    # pointless for now.  Leave it here anyway for the moment, I might be missing something obvious with client
-    # disconnect (maybe we can do it via a requests Session?)
-    _stop_event = threading.Event()
-    sse_url = settings.OH_URL + '/rest/events'
-    ac_set = set(['ac_' + ac for ac in settings.AIRCONS])
+def decode_event(raw):
+    """
+    Pick an oh event apart, doing as little work as possible on the ones we don't care about.  The type and topic are
+    pulled straight out of the raw text, and only events for one of our routes get their payload decoded (the rest
+    of the envelope never is).
+
+    :param raw:     str.  The event data, e.g.
+        {"topic":"openhab/items/ac_x_power_state/command","payload":"{\"type\":\"OnOff\",\"value\":\"ON\"}",
+         "type":"ItemCommandEvent"}
+    :return tuple   (device, property, cleaned value) or None if it's not an event for us.
+    """
+    m = _sse_type_re.search(raw)
+    if m is None or m.group(1) not in SSE_EVENT_TYPES:
+        return None
+    e_type = m.group(1)
+
+    m = _sse_topic_re.search(raw)
+    if m is None:
+        return None
+    topic_split = m.group(1).split('/')
+    if len(topic_split) < 3:
+        return None
+
+    if e_type == 'GroupItemStateChangedEvent':
+        item = topic_split[-3]
+    else:
+        item = topic_split[-2]
+
+    # anything that isn't one of our (oh writable) properties just isn't in here
+    route = _routes.get(item)
+    if route is None:
+        return None
+
+    m = _sse_payload_re.search(raw)
+    if m is None:
+        return None
+    payload, _ = _json_decoder.raw_decode(raw, m.end())
+    value = json.loads(payload).get('value') if payload else None
+    if value is None:
+        return None
+
+    device, prop = route
+    return device, prop, clean_oh_value(value)
+
+
+async def read_events(stream, stall_secs):
+    """
+    Read server sent events from `stream` (an aiohttp StreamReader) and send ours on to the device actors.  Raises
+    asyncio.TimeoutError if nothing at all (events or heartbeats) arrives for `stall_secs`.
+    """
+    data = []
+    while True:
+        line = await asyncio.wait_for(stream.readline(), stall_secs or None)
+        if not line:
+            raise ConnectionError('OH closed the event stream')
+
+        line = line.decode('utf-8').rstrip('\r\n')
+        if line.startswith('data:'):
+            data.append(line[6:] if line.startswith('data: ') else line[5:])
+            continue
+        if line or not data:
+            continue    # some other field (event:, id:, a comment), or a blank line with no event
+
+        # a blank line ends the event
+        _sse_received.inc()
+        decoded = decode_event('\n'.join(data))
+        data = []
+        if decoded is None:
+            _sse_dropped.inc()
+            continue
+        _sse_dispatched.inc()
+        device, our_prop, clean_val = decoded
+        # print("Set {} on {} to {}".format(our_prop, device.name, clean_val))
 
-    def sse_loop():
-        global _devices
-        while not _stop_event.is_set():
+        # hand it over to the device's actor, so we never wait on the cloud here
+        get_actor(device).post(our_prop, clean_val)
+
+
+async def sse_main():
+    """
+    Follow oh's event stream forever (or until cancelled).  After any failure it reconnects after a random delay of up
+    to SSE_RECONNECT_MIN_SECS, doubling up to SSE_RECONNECT_MAX_SECS while it keeps failing.  Every time it
+    (re)connects, all our items are read from oh to catch anything that changed while we weren't listening.
+    """
+    sse_url = settings.OH_URL + '/rest/events'
+    stall_secs = getattr(settings, 'SSE_STALL_SECS', 60)
+    min_delay = getattr(settings, 'SSE_RECONNECT_MIN_SECS', 1)
+    max_delay = getattr(settings, 'SSE_RECONNECT_MAX_SECS', 60)
+    loop = asyncio.get_event_loop()
+
+    delay = min_delay
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+    async with aiohttp.ClientSession(timeout=timeout) as http:
+        while True:
             try:
-                sse_client = sseclient.SSEClient(sse_url)
-                for evt in sse_client:
-                    data = json.loads(evt.data)
-                    topic = data.get('topic')
-                    topic_split = topic.split('/')
-                    e_type = data.get('type')
-
-                    if e_type == 'GroupItemStateChangedEvent':
-                        item = topic_split[-3]
-                    else:
-                        item = topic_split[-2]
-
-                    # logging.debug("{} {} {}".format(topic, e_type, item))
-
-                    if not item.startswith('ac_'):
-                        # all our items of interest start with ac_, so we can ignore anything that doesn't
-                        continue
-
-                    our_ac = None
-                    ac_name = None
-                    our_prop = None
-                    for a in ac_set:
-                        # Note: regexes would be a lot simpler here, but I think this is a lot more efficient
-                        if item.startswith(a + '_'):
-                            our_ac = a
-                            ac_name = a[3:]
-                            our_prop = item[len(a) + 1:]
-                            break
-
-                    if not our_ac:
-                        continue  # doesn't match any ac we have
-
-                    if our_prop not in AC_RW_PROPERTIES:
-                        continue  # not a property that can be changed in oh
-
-                    # only a subset of events interest us
-                    if e_type in {'ItemStateChangedEvent', 'ItemStateEvent', 'GroupItemStateChangedEvent',
-                                  'ItemCommandEvent'}:
-                        payload = json.loads(data.get('payload', '{}'))
-                        # print(repr(payload))
-                        clean_val = clean_oh_value(payload.get('value'))
-                        # print("Set {} on {} to {}".format(our_prop, our_ac, clean_val))
-                        str_val = force_to_string(our_prop, clean_val)
-
-                        device = None
-                        for d in _devices:
-                            if d.name == ac_name:
-                                device = d
-                                break
-
-                        if device is None:
-                            raise Exception('Unable to locate device with name: ' + ac_name)
-
-                        # only need to send to midea if something has changed
-                        if _last_midea_values.get(device.name, {}).get(our_prop) == str_val:
-                            continue
-
-                        try:
-                            # make sure that what we have is current
-                            device.refresh()
-
-                            logging.debug('Push to Midea {}: {} = {}'.format(ac_name, our_prop, clean_val))
-                            setattr(device, our_prop, force_to_midea(our_prop, clean_val))
-                            _last_midea_values[device.name][our_prop] = str_val
-
-                            device.apply()
-                        except DeviceOfflineException:
-                            logging.warning(
-                                'Device {} is offline, not updating settings, and refreshing devices list'.format(
-                                    device.name))
-                            _devices = _client_inst.devices()
-
-            except KeyboardInterrupt:
-                # for this, we give up, regardless of the event state
-                logging.info('Got keyboard interrupt, exiting sse loop.')
-                return
+                async with http.get(sse_url, params={'topics': sse_topics()},
+                                    headers={'Accept': 'text/event-stream'}) as response:
+                    response.raise_for_status()
+                    logging.info('Connected to OH event stream')
+                    _sse_connects.inc()
+                    delay = min_delay
+
+                    await loop.run_in_executor(None, openhab_to_midea)
+                    await read_events(response.content, stall_secs)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                logging.warning('Nothing from OH event stream for {}s, reconnecting'.format(stall_secs))
             except Exception as e:
-                print('Exception in sse_loop: ' + repr(e))
-                logging.exception('Failure in sse_loop')
-                # just sleep for a while and restart the loop.
-                _stop_event.wait(5)
+                print('Exception in sse_main: ' + repr(e))
+                logging.exception('Failure in sse_main')
+
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, max_delay)
+
+
+_sse_loop = None
+_sse_task = None
+
+
+def sse_init():
+    """
+    Run sse_main() on its own event loop thread.
+    """
+    ready = threading.Event()
+
+    def sse_thread():
+        # Our own loop and task, whatever the globals say by the time we're done.  They're only there for sse_stop().
+        global _sse_loop, _sse_task
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(sse_main())
+        _sse_loop, _sse_task = loop, task
+        ready.set()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            logging.info('SSE loop stopped')
+        finally:
+            loop.close()
+
+    threading.Thread(target=sse_thread, name="SSE Loop", daemon=True).start()
+    ready.wait()
 
-    threading.Thread(target=sse_loop, name="SSE Loop", daemon=True).start()
+
+def sse_stop():
+    loop, task = _sse_loop, _sse_task
+    if loop is not None and not loop.is_closed():
+        loop.call_soon_threadsafe(task.cancel)
+
+
+_metrics_server = None
+
+
+def metrics_init():
+    global _metrics_server
+    port = getattr(settings, 'METRICS_PORT', None)
+    if port and _metrics_server is None:
+        _metrics_server = metrics.serve(port, getattr(settings, 'METRICS_HOST', '127.0.0.1'))
 
 
 def main_loop():
+    global _scheduler
+    metrics_init()
     midea_init()
     init_last_values()
-    last_midea_refresh = time.time()
-    midea_to_openhab()
+    oh_writes_init()
+    _scheduler = poll_scheduler()
+    _scheduler.polled(midea_to_openhab(), first=True)
     sse_init()
     try:
         while True:
-            if time.time() - last_midea_refresh > settings.MIDEA_POLL_FREQ_SECS:
-                midea_to_openhab()
-                last_midea_refresh = time.time()
+            due = _scheduler.wait_due()
+            if due:
+                results = {}
+                try:
+                    results = midea_to_openhab(due)
+                finally:
+                    _scheduler.polled(results)
+                    # anything that's dropped out of the device list is picked up again by track() if it comes back
+                    retry = {d.name for d in _devices} - {d.name for d in results}
+                    _scheduler.retry([name for name in due if name in retry])
+            refresh_devices_soon(getattr(settings, 'MIDEA_DEVICE_LIST_TTL_SECS', 10 * 60))
 
             # if time.time() - last_oh_refresh > settings.OPENHAB_POLL_FREQ_SECS:
             #     openhab_to_midea()
             #     last_oh_refresh = time.time()
-
-            time.sleep(1)
     except KeyboardInterrupt:
         logging.warning('Shutting down in response to keyboard interrupt')
-        _stop_event.set()
+        sse_stop()
         return True
     except Exception as e:
         print('Exception: ' + repr(e))
         logging.exception('Failure in main loop')
+        sse_stop()
         return False
 
 
-if __name__ == '__main__':
+def run():
     should_quit = False
     restart_count = 0
     while not should_quit and restart_count < 100:
@@ -441,3 +1170,128 @@ if __name__ == '__main__':
         restart_count += 1
         if not should_quit:
             time.sleep(10.0)
+    return should_quit
+
+
+_shard = None   # which shard this process is, if it's a worker
+
+
+def shards():
+    """
+    Split the work up as configured by WORKERS and ACCOUNTS.
+
+    :return list    of dicts of settings to override, one per worker process.  A single shard means no workers: it all
+        runs in this process.
+    """
+    accounts = getattr(settings, 'ACCOUNTS', None) or [{}]
+    workers = getattr(settings, 'WORKERS', 1)
+
+    result = []
+    for account in accounts:
+        aircons = tuple(account.get('AIRCONS', settings.AIRCONS))
+        count = max(1, min(workers, len(aircons)))
+        for i in range(count):
+            shard = dict(account)
+            shard['AIRCONS'] = aircons[i::count]
+            result.append(shard)
+
+    if len(result) > 1:
+        metrics_port = getattr(settings, 'METRICS_PORT', None)
+        for i, shard in enumerate(result):
+            # each worker has a session of its own, so it needs somewhere of its own to keep it
+            cache_file = shard.get('MIDEA_SESSION_CACHE',
+                                   getattr(settings, 'MIDEA_SESSION_CACHE', '.midea_session.json'))
+            if cache_file:
+                base, ext = os.path.splitext(cache_file)
+                shard['MIDEA_SESSION_CACHE'] = '{}.{}{}'.format(base, i, ext)
+            if metrics_port and 'METRICS_PORT' not in shard:
+                shard['METRICS_PORT'] = metrics_port + i
+    return result
+
+
+def _interrupt_once(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def shard_main(index, overrides):
+    """
+    Worker process: run the whole bridge, for just the aircons (and account) in `overrides`.
+    """
+    global _shard
+    _shard = index
+    for k, v in overrides.items():
+        setattr(settings, k, v)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s [shard {}] %(message)s'.format(index)))
+    # the supervisor stops us with SIGTERM, which should shut down the same way as ^C.  A ^C (or a SIGTERM to the
+    # process group) reaches us as well as the supervisor, so its SIGTERM can come while we're already shutting down.
+    signal.signal(signal.SIGTERM, _interrupt_once)
+    signal.signal(signal.SIGINT, _interrupt_once)
+    logging.info('Shard {} starting with {}'.format(index, ', '.join(settings.AIRCONS)))
+    try:
+        sys.exit(0 if run() else 1)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+def supervise(shard_settings):
+    """
+    Run a worker process per shard, and restart any that die.  One that keeps dying straight away is restarted after
+    longer and longer (up to WORKER_RESTART_MAX_SECS), so it doesn't spin; the others carry on regardless.
+    """
+    min_delay = getattr(settings, 'WORKER_RESTART_MIN_SECS', 1)
+    max_delay = getattr(settings, 'WORKER_RESTART_MAX_SECS', 300)
+    context = multiprocessing.get_context('spawn')
+    processes = [None] * len(shard_settings)
+    started = [0.0] * len(shard_settings)
+    delays = [min_delay] * len(shard_settings)
+    restart_at = [None] * len(shard_settings)
+
+    def start(i):
+        processes[i] = context.Process(target=shard_main, args=(i, shard_settings[i]), name='Shard {}'.format(i))
+        processes[i].start()
+        started[i] = time.monotonic()
+        restart_at[i] = None
+
+    signal.signal(signal.SIGTERM, _interrupt_once)
+    signal.signal(signal.SIGINT, _interrupt_once)
+    logging.info('Starting {} workers'.format(len(shard_settings)))
+    for i in range(len(shard_settings)):
+        start(i)
+
+    try:
+        while True:
+            time.sleep(1.0)
+            now = time.monotonic()
+            for i, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                if restart_at[i] is None:
+                    # only back off if it didn't last long
+                    if now - started[i] > max_delay:
+                        delays[i] = min_delay
+                    logging.warning('Shard {} exited with {}, restarting in {}s'.format(i, process.exitcode, delays[i]))
+                    restart_at[i] = now + delays[i]
+                    delays[i] = min(delays[i] * 2, max_delay)
+                elif now >= restart_at[i]:
+                    start(i)
+    except KeyboardInterrupt:
+        logging.warning('Shutting down workers in response to keyboard interrupt')
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(10)
+
+
+if __name__ == '__main__':
+    shard_settings = shards()
+    if len(shard_settings) > 1:
+        supervise(shard_settings)
+    else:
+        for k, v in shard_settings[0].items():
+            setattr(settings, k, v)
+        run()
@@ -0,0 +1,66 @@
+import time
+
+VERSION = '0.1.7'
+
+
+class circuit_breaker:
+    """
+    Stops us sending anything to a device that's offline.  Once it's failed, requests to it fail straight away
+    (without going anywhere near the cloud) for `min_secs`, then one is let through to see if it's back.  Each time
+    that one fails too, the wait doubles, up to `max_secs`.  A single success closes it again.
+    """
+
+    # What allow() says, when it lets a request through
+    PASS = 'pass'       # the breaker is closed
+    PROBE = 'probe'     # this is the request that's been let through to try the device
+
+    def __init__(self, min_secs=15, max_secs=300):
+        self.min_secs = min_secs
+        self.max_secs = max_secs
+
+        self.delay = 0          # the current wait, 0 while it's closed
+        self.retry_at = 0.0     # time.monotonic() the next request is let through
+        self._probing = False   # a request has been let through to try the device, and hasn't finished yet
+
+    @property
+    def closed(self):
+        return not self.delay
+
+    @property
+    def remaining(self):
+        """
+        Seconds until the next request is let through.
+        """
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def allow(self):
+        """
+        :return         None if nothing can go to the device now, otherwise PASS or PROBE.  After a PROBE, call
+            finished() when it's done, whatever happened.
+        """
+        if not self.delay:
+            return self.PASS
+        if self._probing or time.monotonic() < self.retry_at:
+            return None
+        self._probing = True
+        return self.PROBE
+
+    def succeeded(self):
+        self.delay = 0
+
+    def failed(self):
+        """
+        The device is offline.
+
+        :return number  seconds until it'll be tried again.
+        """
+        now = time.monotonic()
+        if self.delay and now < self.retry_at:
+            return self.retry_at - now     # several requests failed together, it's only one failure
+        self.delay = min(self.delay * 2, self.max_secs) if self.delay else self.min_secs
+        self.retry_at = now + self.delay
+        return self.delay
+
+    def finished(self):
+        # only for the probe, see allow()
+        self._probing = False
@@ -3,10 +3,17 @@
 # The orignal Ruby version can be found here https://github.com/yitsushi/midea-air-condition
 # License MIT - Use as you please and at your own risk
 
+import asyncio
+import threading
+import time
 from typing import Dict, List
 
+from midea.cloud import async_cloud
 from midea.cloud import cloud
 from midea.device import air_conditioning_device
+from midea.device import async_air_conditioning_device
+from midea.device import async_dehumidifier_device
+from midea.device import async_unknown_device
 from midea.device import dehumidifier_device
 from midea.device import unknown_device
 
@@ -17,39 +24,135 @@ DEVICE_TYPES = {
     0x00: dehumidifier_device
 }
 
+ASYNC_DEVICE_TYPES = {
+    0xAC: async_air_conditioning_device,
+    0x00: async_dehumidifier_device
+}
+
 
-def build_device(cloud_service: cloud, device_detail: dict):
+def build_device(cloud_service: cloud, device_detail: dict, device_types=DEVICE_TYPES, default=unknown_device):
     device_type = int(device_detail['type'], 0)
-    device_constructor = DEVICE_TYPES.get(device_type, None)
-    if device_constructor is not None:
-        device = device_constructor(cloud_service)
-    else:
-        device = unknown_device(cloud_service)
+    device_constructor = device_types.get(device_type, default)
+    device = device_constructor(cloud_service)
     device.set_device_detail(device_detail)
     return device
 
 
+def update_devices(cloud_service, devices: dict, device_status_list: list, device_types=DEVICE_TYPES,
+                   default=unknown_device):
+    for device_status in device_status_list:
+        current_device_id = device_status['id']
+        current_device = devices.setdefault(current_device_id, None)
+        if current_device is None:
+            current_device = build_device(cloud_service, device_status, device_types, default)
+            devices[current_device_id] = current_device
+        else:
+            current_device.set_device_detail(device_status)
+
+    return list(devices.values())
+
+
+class async_client:
+
+    def __init__(self, appKey: str, email: str, password: str, **kwargs):
+        # kwargs are passed on to async_cloud, e.g. pool_size
+        self._cloud = async_cloud(appKey, email, password, **kwargs)
+        self._devices = {}  # type: Dict[str, device]
+        self._listed_at = None  # time.monotonic() the device list was last fetched
+        self._list_lock = None  # created on first use, so it belongs to the loop we're running on
+
+    async def setup(self):
+        if not self._cloud.session:
+            await self._cloud.login()
+
+    @property
+    def devices_age(self):
+        """
+        Seconds since the device list was last fetched from the cloud.
+        """
+        return float('inf') if self._listed_at is None else time.monotonic() - self._listed_at
+
+    async def devices(self, max_age=None):
+        """
+        :param max_age: if the device list was fetched no more than this many seconds ago, just return that.  None
+            always fetches it, unless another caller fetched it while we waited for them.
+        """
+        if self._list_lock is None:
+            self._list_lock = asyncio.Lock()
+        asked = time.monotonic()
+        async with self._list_lock:
+            if self._listed_at is not None and (self._listed_at >= asked or
+                                                (max_age is not None and self.devices_age <= max_age)):
+                return list(self._devices.values())
+
+            await self.setup()
+
+            device_status_list = await self._cloud.list()
+            self._listed_at = time.monotonic()
+            return update_devices(self._cloud, self._devices, device_status_list, ASYNC_DEVICE_TYPES,
+                                  async_unknown_device)
+
+    def stats(self):
+        return self._cloud.transport.stats()
+
+    def queue_stats(self):
+        """
+        How long requests have waited for the rate limiter, by priority.
+        """
+        return self._cloud.limiter.stats()
+
+    async def close(self):
+        await self._cloud.close()
+
+
 class client:
+    """
+    Blocking client.  All the cloud traffic goes through async_cloud underneath, so a pool of threads calling
+    refresh()/apply() on different devices will have their requests in flight at the same time.
+    """
 
-    def __init__(self, appKey: str, email: str, password: str):
-        self._cloud = cloud(appKey, email, password)
+    def __init__(self, appKey: str, email: str, password: str, **kwargs):
+        # kwargs are passed on to cloud, e.g. pool_size
+        self._cloud = cloud(appKey, email, password, **kwargs)
         self._devices = {}  # type: Dict[str, device]
+        self._listed_at = None
+        self._list_lock = threading.Lock()
 
     def setup(self):
         if not self._cloud.session:
             self._cloud.login()
 
-    def devices(self):
-        self.setup()
+    @property
+    def devices_age(self):
+        """
+        Seconds since the device list was last fetched from the cloud.
+        """
+        return float('inf') if self._listed_at is None else time.monotonic() - self._listed_at
+
+    def devices(self, max_age=None):
+        """
+        :param max_age: see async_client.devices
+        """
+        asked = time.monotonic()
+        with self._list_lock:
+            if self._listed_at is not None and (self._listed_at >= asked or
+                                                (max_age is not None and self.devices_age <= max_age)):
+                return list(self._devices.values())
+
+            self.setup()
+
+            device_status_list = self._cloud.list()
+            self._listed_at = time.monotonic()
+            return update_devices(self._cloud, self._devices, device_status_list)
+
+    def stats(self):
+        return self._cloud.stats()
 
-        device_status_list = self._cloud.list()
-        for device_status in device_status_list:
-            current_device_id = device_status['id']
-            current_device = self._devices.setdefault(current_device_id, None)
-            if current_device is None:
-                current_device = build_device(self._cloud, device_status)
-                self._devices[current_device_id] = current_device
-            else:
-                current_device.set_device_detail(device_status)
+    def queue_stats(self):
+        """
+        How long requests have waited for the rate limiter, by priority.
+        """
+        return self._cloud.queue_stats()
 
-        return list(self._devices.values())
+    def close(self):
+        self._cloud.close()
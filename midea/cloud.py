@@ -1,20 +1,48 @@
-import requests
+import asyncio
 import datetime
 import json
+import os
+import threading
+import time
 
-from threading import Lock
-
+from midea import metrics
+from midea.breaker import circuit_breaker
+from midea.limiter import PRIORITY_APPLY
+from midea.limiter import PRIORITY_LIST
+from midea.limiter import PRIORITY_POLL
+from midea.limiter import rate_limiter
 from midea.security import security
+from midea.transport import transport
 import logging
-import time
 
 # The Midea cloud client is by far the more obscure part of this library, and without some serious reverse engineering
 # this would not have been possible. Thanks Yitsushi for the ruby implementation. This is an adaptation to Python 3
 
 VERSION = '0.1.7'
 
+# The wire format is a byte per comma separated signed decimal ('-86' for 0xaa).  These go straight between the two.
+_ENCODE = tuple((str(b - 256 if b >= 128 else b)).encode('ascii') for b in range(256))
+_DECODE = {s: b for b, s in enumerate(_ENCODE)}
+_DECODE.update({str(b).encode('ascii'): b for b in range(128, 256)})    # be liberal in what we accept
 
-class cloud:
+
+def _decode_field(text):
+    value = int(text)
+    if not -128 <= value <= 255:
+        raise ValueError('byte out of range: {}'.format(text))
+    return value % 256
+
+_retries = metrics.counter('midea_api_retries_total', 'Midea cloud api requests that were retried', ('endpoint',))
+_errors = metrics.counter('midea_api_errors_total', 'Error codes returned by the midea cloud api', ('code',))
+_logins = metrics.counter('midea_logins_total', 'Logins to the midea cloud')
+_breaker_opened = metrics.counter('midea_device_offline_total', 'Times each device was found to be offline', ('device',))
+_breaker_rejected = metrics.counter('midea_device_rejected_total',
+                                    'Requests to an offline device that failed without being sent', ('device',))
+_send_seconds = metrics.histogram('midea_transparent_send_seconds', 'Round trip time of commands sent to each device',
+                                  ('device',))
+
+
+class async_cloud:
     SERVER_URL = "https://mapp.appsmb.com/v1/"
     CLIENT_TYPE = 1                 # Android
     FORMAT = 2                      # JSON
@@ -22,7 +50,13 @@ class cloud:
     APP_ID = 1017
     SRC = 17
 
-    def __init__(self, app_key, email, password):
+    # Errors on these endpoints are never passed to handle_api_error, as the handlers would just log in again
+    LOGIN_ENDPOINTS = ('user/login/id/get', 'user/login')
+
+    MAX_RETRIES = 3
+
+    def __init__(self, app_key, email, password, pool_size=10, keepalive_secs=120, ping_secs=50, cache_file=None,
+                 server_url=None, rate_limit=None, rate_burst=None, offline_retry_secs=15, offline_retry_max_secs=300):
         # Get this from any of the Midea based apps, you can find one on Yitsushi's github page
         self.app_key = app_key
         self.login_account = email   # Your email address for your Midea account
@@ -40,144 +74,259 @@ class cloud:
         # A list of appliances associated with the account
         self.appliance_list = []
 
-        self._api_lock = Lock()
+        # Only guards the login state, requests themselves are free to run concurrently.  Created on first use, so
+        # that it belongs to the loop we're actually running on.
+        self._api_lock = None
+
+        # Only ever changed for testing, e.g. against bench/fake_cloud.py
+        self.server_url = server_url or self.SERVER_URL
+
+        # Keeps the connections to the server warm between requests
+        self.transport = transport(self.server_url, pool_size, keepalive_secs, ping_secs)
+
+        # Keeps us from sending requests faster than rate_limit a second, and decides who goes first when we'd like to
+        self.limiter = rate_limiter(rate_limit, rate_burst)
 
         self.security = security(self.app_key)
-        self._retries = 0
 
-    def api_request(self, endpoint, args):
+        # (cache_key, access token) -> encrypted order, see appliance_transparent_send
+        self._orders = {}
+
+        # appliance id -> circuit_breaker, so that a device that's offline isn't sent anything until it's likely back
+        self.offline_retry_secs = offline_retry_secs
+        self.offline_retry_max_secs = offline_retry_max_secs
+        self._breakers = {}
+
+        # If set, the login is saved here and picked up again at startup, so a restart doesn't have to log in
+        self.cache_file = cache_file
+        self._load_session()
+
+    def _load_session(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+            if cached.get('loginAccount') != self.login_account or cached.get('appKey') != self.app_key:
+                logging.info('Session cache {} is for a different account, ignoring it'.format(self.cache_file))
+                return
+            self.login_id = cached['loginId']
+            self.session = cached['session']
+            self.security.accessToken = self.session['accessToken']
+            logging.debug('Loaded session from {}'.format(self.cache_file))
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logging.warning('Unable to load session cache {}: {}'.format(self.cache_file, repr(e)))
+            self.login_id = None
+            self.session = {}
+
+    def _save_session(self):
+        if not self.cache_file:
+            return
+        cached = {
+            'loginAccount': self.login_account,
+            'appKey': self.app_key,
+            'loginId': self.login_id,
+            'session': self.session,
+        }
+        # The session is as good as a password, so only we get to read it
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logging.warning('Unable to save session cache {}: {}'.format(self.cache_file, repr(e)))
+
+    def _login_lock(self):
+        if self._api_lock is None:
+            self._api_lock = asyncio.Lock()
+        return self._api_lock
+
+    async def close(self):
+        await self.transport.close()
+
+    async def api_request(self, endpoint, args, retries=0, priority=PRIORITY_POLL):
         """
         Sends an API request to the Midea cloud service and returns the results
         or raises ValueError if there is an error
-        """
-        self._api_lock.acquire()
-        response = {}
-        try:
-            # Set up the initial data payload with the global variable set
-            data = {
-                'appId': self.APP_ID,
-                'format': self.FORMAT,
-                'clientType': self.CLIENT_TYPE,
-                'language': self.LANGUAGE,
-                'src': self.SRC,
-                'stamp': datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-            }
-            # Add the method parameters for the endpoint
-            data.update(args)
 
-            # Add the sessionId if there is a valid session
-            if self.session:
-                data['sessionId'] = self.session['sessionId']
+        :param priority: one of the limiter's PRIORITY_*, for if the request has to wait its turn.  Logins never wait:
+            they're rare, and everything else is waiting on them.
+        """
+        if endpoint not in self.LOGIN_ENDPOINTS:
+            await self.limiter.acquire(priority)
+
+        # Set up the initial data payload with the global variable set
+        data = {
+            'appId': self.APP_ID,
+            'format': self.FORMAT,
+            'clientType': self.CLIENT_TYPE,
+            'language': self.LANGUAGE,
+            'src': self.SRC,
+            'stamp': datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        }
+        # Add the method parameters for the endpoint
+        data.update(args)
 
-            url = self.SERVER_URL + endpoint
+        # Add the sessionId if there is a valid session
+        session = self.session
+        if session:
+            data['sessionId'] = session['sessionId']
 
-            data['sign'] = self.security.sign(url, data)
+        url = self.server_url + endpoint
 
-            logging.debug('API call ' + endpoint + ': ' + repr(data))
+        data['sign'] = self.security.sign(url, data)
 
-            # POST the endpoint with the payload
-            r = requests.post(url=url, data=data)
+        logging.debug('API call ' + endpoint + ': ' + repr(data))
 
-            response = json.loads(r.text)
-        finally:
-            self._api_lock.release()
+        # POST the endpoint with the payload
+        response = json.loads(await self.transport.post(endpoint, data))
 
         # Check for errors, raise if there are any
         if response['errorCode'] != '0':
-            if endpoint != "user/login":    # hack to stop recursion problem on login failures
-                self.handle_api_error(int(response['errorCode']), response['msg'])
+            _errors.inc(response['errorCode'])
+            if endpoint not in self.LOGIN_ENDPOINTS:    # hack to stop recursion problem on login failures
+                await self.handle_api_error(int(response['errorCode']), response['msg'], session)
             # If you don't throw, then retry
             logging.info("Retrying API call: '{}'".format(endpoint))
-            self._retries += 1
-            if self._retries < 3:
-                return self.api_request(endpoint, args)
+            if retries + 1 < self.MAX_RETRIES:
+                _retries.inc(endpoint)
+                return await self.api_request(endpoint, args, retries + 1, priority)
             else:
                 raise RecursionError(response.get('msg'))
 
-        self._retries = 0
         return response['result']
 
-    def get_login_id(self):
+    async def get_login_id(self):
         """
         Get the login ID from the email address
         """
         # let's assume that this doesn't change
         #if self.login_id: return self.login_id
 
-        response = self.api_request("user/login/id/get", {
+        response = await self.api_request("user/login/id/get", {
             'loginAccount': self.login_account
         })
         self.login_id = response['loginId']
 
-    def login(self, force=False):
+    async def login(self, force=False):
         """
         Performs a user login with the credentials supplied to the constructor
         """
+        async with self._login_lock():
+            await self._login(force)
+
+    async def _login(self, force=False):
+        # Caller must hold the login lock
         if not self.login_id or force:
-            self.get_login_id()
+            await self.get_login_id()
 
         if not force and self.session:
-            return  # Don't try logging in again, someone beat this thread to it
+            return  # Don't try logging in again, someone beat this task to it
 
         logging.debug('Call to login with {} {} {}'.format(self.login_id, self.login_account, self.password))
 
         # Log in and store the session
-        self.session = self.api_request("user/login", {
+        self.session = await self.api_request("user/login", {
             'loginAccount': self.login_account,
             'password': self.security.encryptPassword(self.login_id, self.password)
         })
 
         self.security.accessToken = self.session['accessToken']
-        if force: time.sleep(10)    # be patient for a forced login
+        self._orders.clear()
+        _logins.inc()
+        self._save_session()
+        if force: await asyncio.sleep(10)    # be patient for a forced login
 
-    def list(self, home_group_id=-1):
+    async def list(self, home_group_id=-1):
         """
         Lists all appliances associated with the account
         """
 
         # If a homeGroupId is not specified, use the default one
         if home_group_id == -1:
-            li = self.list_homegroups()
+            li = await self.list_homegroups()
             home_group_id = next(
                 x for x in li if x['isDefault'] == '1')['id']
 
-        response = self.api_request('appliance/list/get', {
+        response = await self.api_request('appliance/list/get', {
             'homegroupId': home_group_id
-        })
+        }, priority=PRIORITY_LIST)
 
         self.appliance_list = response['list']
         logging.debug("Device list: {}".format(self.appliance_list))
         return self.appliance_list
 
     def encode(self, data: bytearray):
-        normalized = []
-        for b in data:
-            if b >= 128:
-                b = b - 256
-            normalized.append(str(b))
-
-        string = ','.join(normalized)
-        return bytearray(string.encode('ascii'))
+        table = _ENCODE
+        return bytearray(b','.join([table[b] for b in data]))
 
     def decode(self, data: bytearray):
-        data = [int(a) for a in data.decode('ascii').split(',')]
-        for i in range(len(data)):
-            if data[i] < 0:
-                data[i] = data[i] + 256
-        return bytearray(data)
+        data = bytes(data)
+        try:
+            return bytearray(map(_DECODE.__getitem__, data.split(b',')))
+        except KeyError:
+            # Not quite how we'd have written it (spaces, leading zeros...), so do it the slow way
+            return bytearray(_decode_field(a) for a in data.decode('ascii').split(','))
 
-    def appliance_transparent_send(self, id, data):
-        if not self.session:
-            self.login()
+    async def appliance_transparent_send(self, id, data, cache_key=None, priority=PRIORITY_APPLY):
+        """
+        :param cache_key: if `data` is always the same for this key (like a status request), the encrypted order is
+            kept and reused until the next login
+        :param priority: see api_request
+        :raises DeviceOfflineException: if the device is offline, straight away if it was last time we tried and it's
+            not time to try again yet.
+        """
+        breaker = self._breakers.get(id)
+        if breaker is None:
+            breaker = self._breakers[id] = circuit_breaker(self.offline_retry_secs, self.offline_retry_max_secs)
+        allowed = breaker.allow()
+        if allowed is None:
+            _breaker_rejected.inc(id)
+            raise DeviceOfflineException('{} is offline, trying again in {:.0f}s'.format(id, breaker.remaining))
+        try:
+            reply = await self._transparent_send(id, data, cache_key, priority)
+        except DeviceOfflineException:
+            delay = breaker.failed()
+            _breaker_opened.inc(id)
+            logging.info('Device {} is offline, not trying it again for {:.0f}s'.format(id, delay))
+            raise
+        finally:
+            if allowed == circuit_breaker.PROBE:
+                breaker.finished()
+        breaker.succeeded()
+        return reply
+
+    def offline_retry_in(self, id):
+        """
+        Seconds until something can be sent to device `id` again, if it's offline.  0 if it isn't (as far as we know).
+        """
+        breaker = self._breakers.get(id)
+        return 0.0 if breaker is None or breaker.closed else breaker.remaining
 
-        logging.debug("Sending to {}: {}".format(id, data.hex()))
-        encoded = self.encode(data)
-        order = self.security.aes_encrypt(encoded)
-        response = self.api_request('appliance/transparent/send', {
-            'order': order.hex(),
+    async def _transparent_send(self, id, data, cache_key, priority):
+        if not self.session:
+            await self.login()
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Sending to {}: {}".format(id, data.hex()))
+        order = None
+        if cache_key is not None:
+            cache_key = (cache_key, self.security.accessToken)
+            order = self._orders.get(cache_key)
+        if order is None:
+            order = self.security.aes_encrypt(self.encode(data)).hex()
+            if cache_key is not None:
+                self._orders[cache_key] = order
+        start = time.monotonic()
+        response = await self.api_request('appliance/transparent/send', {
+            'order': order,
             'funId': '0000',
             'applianceId': id
-        })
+        }, priority=priority)
+        _send_seconds.observe(time.monotonic() - start, id)
 
         reply = self.decode(self.security.aes_decrypt(
             bytearray.fromhex(response['reply'])))
@@ -185,42 +334,55 @@ class cloud:
         logging.debug("Received from {}: {}".format(id, reply.hex()))
         return reply
 
-    def list_homegroups(self, force_update=False):
+    async def list_homegroups(self, force_update=False):
         """
         Lists all home groups
         """
 
         # Get all home groups (I think the API supports multiple zones or something)
         if not self.home_groups or force_update:
-            response = self.api_request('homegroup/list/get', {})
+            response = await self.api_request('homegroup/list/get', {}, priority=PRIORITY_LIST)
             self.home_groups = response['list']
 
         return self.home_groups
 
-    def handle_api_error(self, error_code, message: str):
+    async def handle_api_error(self, error_code, message: str, session=None):
+        """
+        `session` is the session the failed request was sent with.  With several requests in flight they'll often all
+        fail together, and only the first one through should actually log in again.
+        """
 
-        def restart():
+        def replaced():
+            return session is not None and self.session and self.session is not session
+
+        async def restart():
             logging.info("Restarting: '{}' - '{}'".format(error_code, message))
-            self.session = None
-            self.get_login_id()
-            self.login()
+            async with self._login_lock():
+                if replaced(): return   # someone beat this task to it
+                self.session = None
+                await self.get_login_id()
+                await self._login()
 
-        def force_restart():
+        async def force_restart():
             logging.info("Restarting forced: '{}' - '{}'".format(error_code, message))
-            self.session = None
-            self.get_login_id()
-            self.login(True)
+            async with self._login_lock():
+                if replaced(): return
+                self.session = None
+                await self.get_login_id()
+                await self._login(True)
 
-        def session_restart():
+        async def session_restart():
             logging.info("Restarting session: '{}' - '{}'".format(error_code, message))
-            self.session = None
-            self.login()
+            async with self._login_lock():
+                if replaced(): return
+                self.session = None
+                await self._login()
 
-        def throw():
-            if error_code == 3123: raise DeviceOfflineException()
+        async def throw():
+            if error_code == 3123: raise DeviceOfflineException(message)
             raise ValueError(error_code, message)
 
-        def ignore():
+        async def ignore():
             logging.info("Error ignored: '{}' - '{}'".format(error_code, message))
 
         error_handlers = {
@@ -232,8 +394,105 @@ class cloud:
         }
 
         handler = error_handlers.get(error_code, throw)
-        handler()
+        await handler()
+
+
+class cloud:
+    """
+    Blocking front end to async_cloud.  The async client runs on a private event loop thread, and each call here just
+    waits on its result, so any number of threads can share one instance and still have their requests in flight
+    together.
+    """
+    SERVER_URL = async_cloud.SERVER_URL
+
+    def __init__(self, app_key, email, password, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name='Midea cloud', daemon=True).start()
+        self._cloud = async_cloud(app_key, email, password, **kwargs)
+        self._closed = False
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    @property
+    def async_cloud(self):
+        return self._cloud
+
+    @property
+    def login_id(self):
+        return self._cloud.login_id
+
+    @property
+    def session(self):
+        return self._cloud.session
+
+    @property
+    def home_groups(self):
+        return self._cloud.home_groups
+
+    @property
+    def appliance_list(self):
+        return self._cloud.appliance_list
+
+    @property
+    def security(self):
+        return self._cloud.security
+
+    @property
+    def transport(self):
+        return self._cloud.transport
+
+    @property
+    def limiter(self):
+        return self._cloud.limiter
+
+    def api_request(self, endpoint, args, priority=PRIORITY_POLL):
+        return self._run(self._cloud.api_request(endpoint, args, priority=priority))
+
+    def get_login_id(self):
+        return self._run(self._cloud.get_login_id())
+
+    def login(self, force=False):
+        return self._run(self._cloud.login(force))
+
+    def list(self, home_group_id=-1):
+        return self._run(self._cloud.list(home_group_id))
+
+    def encode(self, data: bytearray):
+        return self._cloud.encode(data)
+
+    def decode(self, data: bytearray):
+        return self._cloud.decode(data)
+
+    def appliance_transparent_send(self, id, data, cache_key=None, priority=PRIORITY_APPLY):
+        return self._run(self._cloud.appliance_transparent_send(id, data, cache_key, priority))
+
+    def offline_retry_in(self, id):
+        return self._cloud.offline_retry_in(id)
+
+    async def _call(self, fn):
+        return fn()
+
+    def stats(self):
+        # The timings are only safe to read on the loop thread, which is adding to them
+        return self._run(self._call(self._cloud.transport.stats))
+
+    def queue_stats(self):
+        return self._run(self._call(self._cloud.limiter.stats))
+
+    def list_homegroups(self, force_update=False):
+        return self._run(self._cloud.list_homegroups(force_update))
+
+    def handle_api_error(self, error_code, message: str):
+        return self._run(self._cloud.handle_api_error(error_code, message))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._run(self._cloud.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
 
 
 class DeviceOfflineException(Exception):
-    pass
\ No newline at end of file
+    pass
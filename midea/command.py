@@ -1,4 +1,6 @@
 
+import struct
+
 import midea.crc8 as crc8
 import logging
 
@@ -6,15 +8,16 @@ VERSION = '0.1.7'
 
 
 class base_command:
+    # More magic numbers. I'm sure each of these have a purpose, but none of it is documented in english. I might make an effort to google translate the SDK
+    TEMPLATE = bytes([
+        0xaa, 0x23, 0xAC, 0x00, 0x00, 0x00, 0x00, 0x00,
+        0x03, 0x02, 0x40, 0x81, 0x00, 0xff, 0x03, 0xff,
+        0x00, 0x30, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+        0x00, 0x00, 0x00, 0x00, 0x03, 0xcc
+    ])
 
     def __init__(self, device_type=0xAC):
-        # More magic numbers. I'm sure each of these have a purpose, but none of it is documented in english. I might make an effort to google translate the SDK
-        self.data = bytearray([
-            0xaa, 0x23, 0xAC, 0x00, 0x00, 0x00, 0x00, 0x00,
-            0x03, 0x02, 0x40, 0x81, 0x00, 0xff, 0x03, 0xff,
-            0x00, 0x30, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            0x00, 0x00, 0x00, 0x00, 0x03, 0xcc
-        ])
+        self.data = bytearray(self.TEMPLATE)
         self.data[0x02] = device_type
 
     def finalize(self):
@@ -102,157 +105,95 @@ class set_command(base_command):
 
 
 class appliance_response:
+    """
+    A status reply from the appliance, decoded in one go when it's made.  The fields are plain attributes.
+    """
+    __slots__ = ('power_state', 'imode_resume', 'timer_mode', 'appliance_error', 'target_temperature',
+                 'operational_mode', 'fan_speed', 'on_timer', 'off_timer', 'swing_mode', 'cozy_sleep', 'save',
+                 'low_frequency_fan', 'super_fan', 'feel_own', 'child_sleep_mode', 'exchange_air', 'dry_clean',
+                 'aux_heat', 'eco_mode', 'clean_up', 'temp_unit', 'sleep_function', 'turbo_mode', 'catch_cold',
+                 'night_light', 'peak_elec', 'natural_fan', 'indoor_temperature', 'outdoor_temperature', 'humidity')
+
+    # The response data from the appliance includes a packet header which we don't want
+    HEADER_LENGTH = 0x32
+    # Bytes 0x00 to 0x0d of what's left are all we know how to read
+    _body = struct.Struct('14B')
+
+    @classmethod
+    def status_bytes(cls, data):
+        """
+        The part of a reply the response is decoded from.  The rest (the header, with its message ids and timestamps)
+        is different every time, so two replies with the same status_bytes decode to the same thing.
+        """
+        return bytes(data[cls.HEADER_LENGTH:cls.HEADER_LENGTH + cls._body.size])
 
     def __init__(self, data: bytearray):
-        # The response data from the appliance includes a packet header which we don't want
-        self.data = data[0x32:]
-        logging.debug("Appliance response data: {}".format(self.data.hex()))
-
-    # Byte 0x01
-
-    @property
-    def power_state(self):
-        return (self.data[0x01] & 0x1) > 0
-
-    @property
-    def imode_resume(self):
-        return (self.data[0x01] & 0x4) > 0
-
-    @property
-    def timer_mode(self):
-        return (self.data[0x01] & 0x10) > 0
-
-    @property
-    def appliance_error(self):
-        return (self.data[0x01] & 0x80) > 0
-
-    # Byte 0x02
-    @property
-    def target_temperature(self):
-        return (self.data[0x02] & 0xf) + 16
-
-    @property
-    def operational_mode(self):
-        return (self.data[0x02] & 0xe0) >> 5
-
-    # Byte 0x03
-    @property
-    def fan_speed(self):
-        return self.data[0x03] & 0x7f
-
-    # Byte 0x04 + 0x06
-    @property
-    def on_timer(self):
-        on_timer_value = self.data[0x04]
-        on_timer_minutes = self.data[0x06]
-        return {
-            'status': ((on_timer_value & 0x80) >> 7) > 0,
-            'hour': (on_timer_value & 0x7c) >> 2,
-            'minutes': (on_timer_value & 0x3) | ((on_timer_minutes & 0xf0) >> 4)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Appliance response data: {}".format(memoryview(data)[self.HEADER_LENGTH:].hex()))
+
+        # Straight out of the reply, without copying it
+        (_, b01, b02, b03, b04, b05, b06, b07, b08, b09, b0a, b0b, b0c, b0d) = \
+            self._body.unpack_from(data, self.HEADER_LENGTH)
+
+        # Byte 0x01
+        self.power_state = (b01 & 0x1) > 0
+        self.imode_resume = (b01 & 0x4) > 0
+        self.timer_mode = (b01 & 0x10) > 0
+        self.appliance_error = (b01 & 0x80) > 0
+
+        # Byte 0x02
+        self.target_temperature = (b02 & 0xf) + 16
+        self.operational_mode = (b02 & 0xe0) >> 5
+
+        # Byte 0x03
+        self.fan_speed = b03 & 0x7f
+
+        # Byte 0x04 + 0x06
+        self.on_timer = {
+            'status': ((b04 & 0x80) >> 7) > 0,
+            'hour': (b04 & 0x7c) >> 2,
+            'minutes': (b04 & 0x3) | ((b06 & 0xf0) >> 4)
         }
 
-    # Byte 0x05 + 0x06
-    @property
-    def off_timer(self):
-        off_timer_value = self.data[0x05]
-        off_timer_minutes = self.data[0x06]
-        return {
-            'status': ((off_timer_value & 0x80) >> 7) > 0,
-            'hour': (off_timer_value & 0x7c) >> 2,
-            'minutes': (off_timer_value & 0x3) | (off_timer_minutes & 0xf)
+        # Byte 0x05 + 0x06
+        self.off_timer = {
+            'status': ((b05 & 0x80) >> 7) > 0,
+            'hour': (b05 & 0x7c) >> 2,
+            'minutes': (b05 & 0x3) | (b06 & 0xf)
         }
 
-    # Byte 0x07
-    @property
-    def swing_mode(self):
-        return self.data[0x07] & 0x0f
-
-    # Byte 0x08
-    @property
-    def cozy_sleep(self):
-        return self.data[0x08] & 0x03
-
-    @property
-    def save(self):  # This needs a better name, dunno what it actually means
-        return (self.data[0x08] & 0x08) > 0
-
-    @property
-    def low_frequency_fan(self):
-        return (self.data[0x08] & 0x10) > 0
-
-    @property
-    def super_fan(self):
-        return (self.data[0x08] & 0x20) > 0
-
-    @property
-    def feel_own(self):  # This needs a better name, dunno what it actually means
-        return (self.data[0x08] & 0x80) > 0
-
-    # Byte 0x09
-    @property
-    def child_sleep_mode(self):
-        return (self.data[0x09] & 0x01) > 0
-
-    @property
-    def exchange_air(self):
-        return (self.data[0x09] & 0x02) > 0
-
-    @property
-    def dry_clean(self):  # This needs a better name, dunno what it actually means
-        return (self.data[0x09] & 0x04) > 0
-
-    @property
-    def aux_heat(self):
-        return (self.data[0x09] & 0x08) > 0
-
-    @property
-    def eco_mode(self):
-        return (self.data[0x09] & 0x10) > 0
-
-    @property
-    def clean_up(self):  # This needs a better name, dunno what it actually means
-        return (self.data[0x09] & 0x20) > 0
-
-    @property
-    def temp_unit(self):  # This needs a better name, dunno what it actually means
-        return (self.data[0x09] & 0x80) > 0
-
-    # Byte 0x0a
-    @property
-    def sleep_function(self):
-        return (self.data[0x0a] & 0x01) > 0
-
-    @property
-    def turbo_mode(self):
-        return (self.data[0x0a] & 0x02) > 0
-
-    @property
-    def catch_cold(self):   # This needs a better name, dunno what it actually means
-        return (self.data[0x0a] & 0x08) > 0
-
-    @property
-    def night_light(self):   # This needs a better name, dunno what it actually means
-        return (self.data[0x0a] & 0x10) > 0
-
-    @property
-    def peak_elec(self):   # This needs a better name, dunno what it actually means
-        return (self.data[0x0a] & 0x20) > 0
-
-    @property
-    def natural_fan(self):   # This needs a better name, dunno what it actually means
-        return (self.data[0x0a] & 0x40) > 0
-
-    # Byte 0x0b
-    @property
-    def indoor_temperature(self):
-        return (self.data[0x0b] - 50) / 2.0
-
-    # Byte 0x0c
-    @property
-    def outdoor_temperature(self):
-        return (self.data[0x0c] - 50) / 2.0
-
-    # Byte 0x0d
-    @property
-    def humidity(self):
-        return (self.data[0x0d] & 0x7f)
+        # Byte 0x07
+        self.swing_mode = b07 & 0x0f
+
+        # Byte 0x08
+        self.cozy_sleep = b08 & 0x03
+        self.save = (b08 & 0x08) > 0  # This needs a better name, dunno what it actually means
+        self.low_frequency_fan = (b08 & 0x10) > 0
+        self.super_fan = (b08 & 0x20) > 0
+        self.feel_own = (b08 & 0x80) > 0  # This needs a better name, dunno what it actually means
+
+        # Byte 0x09
+        self.child_sleep_mode = (b09 & 0x01) > 0
+        self.exchange_air = (b09 & 0x02) > 0
+        self.dry_clean = (b09 & 0x04) > 0  # This needs a better name, dunno what it actually means
+        self.aux_heat = (b09 & 0x08) > 0
+        self.eco_mode = (b09 & 0x10) > 0
+        self.clean_up = (b09 & 0x20) > 0  # This needs a better name, dunno what it actually means
+        self.temp_unit = (b09 & 0x80) > 0  # This needs a better name, dunno what it actually means
+
+        # Byte 0x0a
+        self.sleep_function = (b0a & 0x01) > 0
+        self.turbo_mode = (b0a & 0x02) > 0
+        self.catch_cold = (b0a & 0x08) > 0   # This needs a better name, dunno what it actually means
+        self.night_light = (b0a & 0x10) > 0   # This needs a better name, dunno what it actually means
+        self.peak_elec = (b0a & 0x20) > 0   # This needs a better name, dunno what it actually means
+        self.natural_fan = (b0a & 0x40) > 0   # This needs a better name, dunno what it actually means
+
+        # Byte 0x0b
+        self.indoor_temperature = (b0b - 50) / 2.0
+
+        # Byte 0x0c
+        self.outdoor_temperature = (b0c - 50) / 2.0
+
+        # Byte 0x0d
+        self.humidity = (b0d & 0x7f)
@@ -37,13 +37,22 @@ crc8_854_table = [
 ]
 
 
-def calculate(data):
-    crc_value = 0
+# Indexing bytes is quicker than indexing a list
+_table = bytes(crc8_854_table)
+
+
+def update(crc_value, data):
+    """
+    Carry on a crc from `crc_value` over `data`, so the crc of a + b is update(calculate(a), b).
+    :param crc_value: the crc so far (0 to start from scratch)
+    :param data: bytes, bytearray or memoryview
+    :return: the crc after `data`
+    """
+    table = _table
     for m in data:
-        k = crc_value ^ m
-        if k > 256:
-            k -= 256
-        if k < 0:
-            k += 256
-        crc_value = crc8_854_table[k]
+        crc_value = table[crc_value ^ m]
     return crc_value
+
+
+def calculate(data):
+    return update(0, data)
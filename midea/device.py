@@ -1,8 +1,13 @@
 
 from enum import Enum
+from functools import lru_cache
+
+import time
 
 import midea.crc8 as crc8
+from midea.cloud import async_cloud
 from midea.cloud import cloud
+from midea.limiter import PRIORITY_POLL
 from midea.command import appliance_response
 from midea.command import base_command as request_status_command
 from midea.command import set_command
@@ -12,10 +17,23 @@ import logging
 VERSION = '0.1.7'
 
 
+@lru_cache(maxsize=None)
+def status_frame(device_type):
+    """
+    The status request is the same every time for a given type of device, so only build it once.
+    """
+    cmd = request_status_command(device_type)
+    pkt_builder = packet_builder()
+    pkt_builder.set_command(cmd)
+    return bytes(pkt_builder.finalize())
+
+
 class device:
 
     def __init__(self, cloud_service: cloud):
         self._cloud_service = cloud_service
+        self._last_update = None    # time.monotonic() of the last state we got from the device
+        self._status_raw = None     # appliance_response.status_bytes() our state was last decoded from
 
     def set_device_detail(self, device_detail: dict):
         self._id = device_detail['id']
@@ -28,12 +46,23 @@ class device:
         self._updating = False
         self._defer_update = False
 
-    def refresh(self):
+    def refresh(self, priority=PRIORITY_POLL):
+        """
+        :param priority: what sort of refresh this is, if the cloud is rate limiting us.  See midea.limiter.
+        """
         pass
 
     def apply(self):
         pass
 
+    def _status_frame(self):
+        return status_frame(self.type)
+
+    def _send_status(self, priority):
+        # The encrypted status request can be reused too (until the next login), so let the cloud cache that
+        return self._cloud_service.appliance_transparent_send(self.id, self._status_frame(),
+                                                              cache_key=('status', self.type), priority=priority)
+
     @property
     def id(self):
         return self._id
@@ -62,6 +91,30 @@ class device:
     def online(self):
         return self._online
 
+    @property
+    def status_raw(self):
+        """
+        The appliance_response.status_bytes() the current state was decoded from, or None if it's been changed since
+        (or never was).  If this hasn't changed, neither has the state.
+        """
+        return self._status_raw
+
+    @property
+    def offline_retry_secs(self):
+        """
+        Seconds until the cloud will send anything to the device again, if it's offline.  0 if it isn't.
+        """
+        return self._cloud_service.offline_retry_in(self.id)
+
+    @property
+    def state_age(self):
+        """
+        Seconds since the state was last read from the device (by a refresh, or the response to an apply).
+        """
+        if self._last_update is None:
+            return float('inf')
+        return time.monotonic() - self._last_update
+
 
 class air_conditioning_device(device):
 
@@ -78,8 +131,9 @@ class air_conditioning_device(device):
 
         @staticmethod
         def get(value):
-            if(value in air_conditioning_device.fan_speed_enum._value2member_map_):
-                return air_conditioning_device.fan_speed_enum(value)
+            member = air_conditioning_device.fan_speed_enum._value2member_map_.get(value)
+            if member is not None:
+                return member
             logging.warning("Unknown Fan Speed: {}".format(value))
             return air_conditioning_device.fan_speed_enum.Auto
 
@@ -96,8 +150,9 @@ class air_conditioning_device(device):
 
         @staticmethod
         def get(value):
-            if(value in air_conditioning_device.operational_mode_enum._value2member_map_):
-                return air_conditioning_device.operational_mode_enum(value)
+            member = air_conditioning_device.operational_mode_enum._value2member_map_.get(value)
+            if member is not None:
+                return member
             logging.warning("Unknown Operational Mode: {}".format(value))
             return air_conditioning_device.operational_mode_enum.fan_only
 
@@ -113,8 +168,9 @@ class air_conditioning_device(device):
 
         @staticmethod
         def get(value):
-            if(value in air_conditioning_device.swing_mode_enum._value2member_map_):
-                return air_conditioning_device.swing_mode_enum(value)
+            member = air_conditioning_device.swing_mode_enum._value2member_map_.get(value)
+            if member is not None:
+                return member
             logging.warning("Unknown Swing Mode: {}".format(value))
             return air_conditioning_device.swing_mode_enum.Off
 
@@ -136,42 +192,80 @@ class air_conditioning_device(device):
         self._outdoor_temperature = 0.0 # this is wrong
         self._humidity = 0  # not sure if this one is working either
 
-    def refresh(self):
-        cmd = request_status_command(self.type)
-        pkt_builder = packet_builder()
-        pkt_builder.set_command(cmd)
-
-        data = pkt_builder.finalize()
-        data = self._cloud_service.appliance_transparent_send(self.id, data)
-        response = appliance_response(data)
-        self._defer_update = False
-        self.update(response)
+    def refresh(self, priority=PRIORITY_POLL):
+        data = self._send_status(priority)
+        self._refreshed(data)
 
     def apply(self):
         self._updating = True
         try:
-            cmd = set_command(self.type)
-            cmd.audible_feedback = self._audible_feedback
-            cmd.power_state = self._power_state
-            cmd.target_temperature = self._target_temperature
-            cmd.operational_mode = self._operational_mode.value
-            cmd.fan_speed = self._fan_speed.value
-            cmd.swing_mode = self._swing_mode.value
-            cmd.eco_mode = self._eco_mode
-            cmd.turbo_mode = self._turbo_mode
-
-            pkt_builder = packet_builder()
-            pkt_builder.set_command(cmd)
-
-            data = pkt_builder.finalize()
-            data = self._cloud_service.appliance_transparent_send(self.id, data)
-            response = appliance_response(data)
-            if not self._defer_update:
-                self.update(response)
+            data = self._cloud_service.appliance_transparent_send(self.id, self._set_frame())
+            self._applied(data)
         finally:
             self._updating = False
             self._defer_update = False
 
+    def _set_frame(self):
+        cmd = set_command(self.type)
+        cmd.audible_feedback = self._audible_feedback
+        cmd.power_state = self._power_state
+        cmd.target_temperature = self._target_temperature
+        cmd.operational_mode = self._operational_mode.value
+        cmd.fan_speed = self._fan_speed.value
+        cmd.swing_mode = self._swing_mode.value
+        cmd.eco_mode = self._eco_mode
+        cmd.turbo_mode = self._turbo_mode
+
+        pkt_builder = packet_builder()
+        pkt_builder.set_command(cmd)
+        return pkt_builder.finalize()
+
+    # Which bytes of the status each property is decoded from, see appliance_response
+    STATUS_BYTES = {
+        'power_state': (0x01,),
+        'target_temperature': (0x02,),
+        'operational_mode': (0x02,),
+        'fan_speed': (0x03,),
+        'on_timer': (0x04, 0x06),
+        'off_timer': (0x05, 0x06),
+        'swing_mode': (0x07,),
+        'eco_mode': (0x09,),
+        'turbo_mode': (0x0a,),
+        'indoor_temperature': (0x0b,),
+        'outdoor_temperature': (0x0c,),
+        'humidity': (0x0d,),
+    }
+
+    def _set_locally(self):
+        # Called by the setters.  The state is now ours rather than what the device last told us.
+        if self._updating:
+            self._defer_update = True
+        self._status_raw = None
+
+    def _refreshed(self, data):
+        self._defer_update = False
+        raw = appliance_response.status_bytes(data)
+        if raw == self._status_raw:
+            # Nothing's changed, so there's nothing to decode
+            self._last_update = time.monotonic()
+            return
+        self.update(appliance_response(data))
+        self._status_raw = raw
+
+    def _applied(self, data):
+        if not self._defer_update:
+            self.update(appliance_response(data))
+            self._status_raw = appliance_response.status_bytes(data)
+
+    def changed_properties(self, status_raw):
+        """
+        The properties that decode differently from `status_raw` than from our status_raw.
+        """
+        if status_raw is None or self._status_raw is None:
+            return list(self.STATUS_BYTES)
+        changed = {i for i, (a, b) in enumerate(zip(status_raw, self._status_raw)) if a != b}
+        return [prop for prop, offsets in self.STATUS_BYTES.items() if not changed.isdisjoint(offsets)]
+
     def update(self, res: appliance_response):
         self._power_state = res.power_state
         self._target_temperature = res.target_temperature
@@ -188,6 +282,7 @@ class air_conditioning_device(device):
         self._timer_on = res.on_timer
         self._timer_off = res.off_timer
         self._humidity = res.humidity
+        self._last_update = time.monotonic()
 
     @property
     def audible_feedback(self):
@@ -195,8 +290,7 @@ class air_conditioning_device(device):
 
     @audible_feedback.setter
     def audible_feedback(self, feedback: bool):
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._audible_feedback = feedback
 
     @property
@@ -205,8 +299,7 @@ class air_conditioning_device(device):
 
     @power_state.setter
     def power_state(self, state: bool):
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._power_state = state
 
     @property
@@ -215,8 +308,7 @@ class air_conditioning_device(device):
 
     @target_temperature.setter
     def target_temperature(self, temperature: int):
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._target_temperature = temperature
 
     @property
@@ -225,8 +317,7 @@ class air_conditioning_device(device):
 
     @operational_mode.setter
     def operational_mode(self, mode: operational_mode_enum):  # @UndefinedVariable
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._operational_mode = mode
 
     @property
@@ -235,8 +326,7 @@ class air_conditioning_device(device):
 
     @fan_speed.setter
     def fan_speed(self, speed: fan_speed_enum):  # @UndefinedVariable
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._fan_speed = speed
 
     @property
@@ -245,8 +335,7 @@ class air_conditioning_device(device):
 
     @swing_mode.setter
     def swing_mode(self, mode: swing_mode_enum):  # @UndefinedVariable
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._swing_mode = mode
 
     @property
@@ -255,8 +344,7 @@ class air_conditioning_device(device):
 
     @eco_mode.setter
     def eco_mode(self, enabled: bool):
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._eco_mode = enabled
 
     @property
@@ -265,8 +353,7 @@ class air_conditioning_device(device):
 
     @turbo_mode.setter
     def turbo_mode(self, enabled: bool):
-        if self._updating:
-            self._defer_update = True
+        self._set_locally()
         self._turbo_mode = enabled
 
     @property
@@ -295,13 +382,14 @@ class unknown_device(device):
     def __init__(self, cloud_service: cloud):
         super().__init__(cloud_service)
 
-    def refresh(self):
-        cmd = request_status_command(self.type)
-        pkt_builder = packet_builder()
-        pkt_builder.set_command(cmd)
+    def refresh(self, priority=PRIORITY_POLL):
+        data = self._send_status(priority)
+        self._refreshed(data)
+
+    def apply(self):
+        logging.warning("Cannot apply, device not fully supported yet")
 
-        data = pkt_builder.finalize()
-        data = self._cloud_service.appliance_transparent_send(self.id, data)
+    def _refreshed(self, data):
         response = appliance_response(data)
         logging.info("Decoded Data: {}".format({
             'audible_feedback': response.audible_feedback,
@@ -315,11 +403,49 @@ class unknown_device(device):
             'turbo_mode': response.turbo_mode
         }))
 
-    def apply(self):
-        logging.warning("Cannot apply, device not fully supported yet")
-
 
 class dehumidifier_device(unknown_device):
 
     def __init__(self, cloud_service: cloud):
         super().__init__(cloud_service)
+
+
+# The async variants share all of the state and framing with the classes above, only the round trip to the cloud is
+# awaited.  They expect an async_cloud rather than a cloud.
+
+class async_air_conditioning_device(air_conditioning_device):
+
+    def __init__(self, cloud_service: async_cloud):
+        super().__init__(cloud_service)
+
+    async def refresh(self, priority=PRIORITY_POLL):
+        data = await self._send_status(priority)
+        self._refreshed(data)
+
+    async def apply(self):
+        self._updating = True
+        try:
+            data = await self._cloud_service.appliance_transparent_send(self.id, self._set_frame())
+            self._applied(data)
+        finally:
+            self._updating = False
+            self._defer_update = False
+
+
+class async_unknown_device(unknown_device):
+
+    def __init__(self, cloud_service: async_cloud):
+        super().__init__(cloud_service)
+
+    async def refresh(self, priority=PRIORITY_POLL):
+        data = await self._send_status(priority)
+        self._refreshed(data)
+
+    async def apply(self):
+        super().apply()
+
+
+class async_dehumidifier_device(async_unknown_device):
+
+    def __init__(self, cloud_service: async_cloud):
+        super().__init__(cloud_service)
@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import time
+import weakref
+
+from midea import metrics
+
+VERSION = '0.1.7'
+
+# Request priorities, most urgent first.  When the limiter is holding requests back, a lower number always goes
+# first, so a change someone is waiting on never queues behind a poll of every aircon in the house.
+PRIORITY_APPLY = 0      # sending a change (and the refresh just before it)
+PRIORITY_CONFIRM = 1    # polling a device we've just changed, to check the change took
+PRIORITY_POLL = 2       # routine polling
+PRIORITY_LIST = 3       # the device list (and the home groups it needs)
+
+PRIORITY_NAMES = ('apply', 'confirm', 'poll', 'list')
+
+_wait_seconds = metrics.histogram('midea_api_queue_wait_seconds',
+                                  'Time midea cloud api requests were held back by the rate limiter', ('priority',))
+_throttled = metrics.counter('midea_api_throttled_total', 'Midea cloud api requests that had to wait for the rate '
+                             'limiter', ('priority',))
+_limiters = weakref.WeakSet()
+metrics.gauge('midea_api_queue_depth', 'Midea cloud api requests waiting for the rate limiter',
+              lambda: sum(limiter.depth for limiter in list(_limiters)))
+
+
+class wait_timing:
+    """
+    Running figures for the time requests of one priority spent waiting.  All times in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.waited = 0     # how many of them had to wait at all
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        if elapsed > 0:
+            self.waited += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'waited': self.waited,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class rate_limiter:
+    """
+    Token bucket in front of the cloud api: on average no more than `rate` requests a second, with bursts of up to
+    `burst`.  Requests that have to wait are let through by priority (see PRIORITY_*), then in the order they arrived.
+
+    Must only be used from one event loop.  A `rate` of None (or 0) lets everything straight through.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = max(1, burst or 1)
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters = []      # (priority, seq, future)
+        self._seq = 0
+        self._wakeup = None     # TimerHandle for when the next waiter can go
+        self._timings = {}      # priority -> wait_timing
+        _limiters.add(self)
+
+    @property
+    def depth(self):
+        """
+        Requests waiting for a token right now.
+        """
+        return sum(1 for _, _, f in self._waiters if not f.done())
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _record(self, priority, elapsed):
+        name = PRIORITY_NAMES[priority]
+        timing = self._timings.get(priority)
+        if timing is None:
+            timing = self._timings[priority] = wait_timing()
+        timing.add(elapsed)
+        _wait_seconds.observe(elapsed, name)
+        if elapsed > 0:
+            _throttled.inc(name)
+
+    async def acquire(self, priority=PRIORITY_POLL):
+        """
+        Wait for our turn to send a request.
+
+        :return float   seconds waited.
+        """
+        if not self.rate:
+            return 0.0
+
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            self._record(priority, 0.0)
+            return 0.0
+
+        future = asyncio.get_event_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._wakeup is None:
+            self._release()
+        await future    # if we're cancelled, _release() just skips over us
+        elapsed = time.monotonic() - now
+        self._record(priority, elapsed)
+        return elapsed
+
+    def _release(self):
+        # Hand out whatever tokens there are to the most urgent waiters, and come back when the next one is due
+        self._wakeup = None
+        self._refill(time.monotonic())
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self._waiters:
+            self._wakeup = asyncio.get_event_loop().call_later((1 - self._tokens) / self.rate, self._release)
+
+    def stats(self):
+        return {PRIORITY_NAMES[p]: t.as_dict() for p, t in sorted(self._timings.items())}
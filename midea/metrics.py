@@ -0,0 +1,151 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+VERSION = '0.1.7'
+
+# Everything created here, in the order it'll be rendered
+_registry = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_str(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class counter:
+    """
+    A count that only goes up, optionally split by labels, e.g.
+        errors = counter('midea_api_errors_total', 'Error codes from the api', ('code',))
+        errors.inc(3106)
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {} if labels else {(): 0}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name + _label_str(self.labels, label_values), value
+
+
+class gauge:
+    """
+    A value read from `fn` whenever the metrics are rendered, e.g. the length of a queue.  If `fn` returns a count
+    that only goes up, pass kind='counter'.
+    """
+
+    def __init__(self, name, help, fn, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.TYPE = kind
+        _registry.append(self)
+
+    def samples(self):
+        yield self.name, self.fn()
+
+
+class histogram:
+    """
+    Counts of observations (normally durations in seconds) by bucket, optionally split by labels.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}   # label values -> [count per bucket (not cumulative) + overflow, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(k, list(v[0]), v[1]) for k, v in self._values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for le, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket' + _label_str(self.labels, label_values, 'le="{}"'.format(le)), cumulative
+            yield self.name + '_sum' + _label_str(self.labels, label_values), total
+            yield self.name + '_count' + _label_str(self.labels, label_values), cumulative
+
+
+def render():
+    """
+    All the metrics, in the prometheus text format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.TYPE))
+        for name, value in metric.samples():
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+class _handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # one line per scrape is just noise
+
+
+class _server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serve the metrics on http://host:port/metrics from a background thread.
+    """
+    httpd = _server((host, port), _handler)
+    threading.Thread(target=httpd.serve_forever, name='Metrics', daemon=True).start()
+    logging.info('Serving metrics on http://{}:{}/metrics'.format(host, port))
+    return httpd
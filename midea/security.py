@@ -8,14 +8,30 @@ from Crypto.Cipher import AES   # pip3 install pycryptodome
 VERSION = '0.1.7'
 
 # Much secure, very null... IV of 0's... Why even have encryption at this point?
+# (It's only kept for reference, CBC with a zero IV on single blocks is exactly ECB, which is what we use)
 INITIALIZATION_VECTOR = b'\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0'
 
 class security:
 
     def __init__(self, appKey):
         self.appKey = appKey
-        self.accessToken = None
         self.blockSize = 16
+        self._accessToken = None
+
+        # data_key() is derived from the access token, so keep it (and a cipher for it) until the token changes
+        self._data_key = None
+        self._data_cipher = None
+
+    @property
+    def accessToken(self):
+        return self._accessToken
+
+    @accessToken.setter
+    def accessToken(self, token):
+        if token != self._accessToken:
+            self._data_key = None
+            self._data_cipher = None
+        self._accessToken = token
 
     def sign(self, url, payload):
         # We only need the path
@@ -45,49 +61,28 @@ class security:
         m.update(loginHash.encode('ascii'))
         return m.hexdigest()
 
+    def _cipher(self, key):
+        # A zero IV CBC cipher that gets reset for every block is just ECB, so do the whole buffer in one go
+        if key is None:
+            if self._data_cipher is None:
+                self._data_cipher = AES.new(self.data_key(), AES.MODE_ECB)
+            return self._data_cipher
+        return AES.new(key, AES.MODE_ECB)
+
     def aes_decrypt(self, raw, key = None):
         # If the key is not set, then use the data_key from the access_token that comes from the current session
-        if not key:
-            key = self.data_key()
-
-        final = bytearray([])
-        # Break up the data into blockSize sized blocks
-        blocks = [raw[i:i+self.blockSize] for i in range(0, len(raw), self.blockSize)]
-
-        # Decrypt each block with a new Cipher. There doesn't seem to be a reset in Python for the Cipher object
-        for block in blocks:
-            cipher = AES.new(key, AES.MODE_CBC, INITIALIZATION_VECTOR)
-            decrypted = cipher.decrypt(bytes(block))
-            final.extend(decrypted)
+        decrypted = self._cipher(key).decrypt(bytes(raw))
 
         # Remove the padding
-        final = self._unpad(final)
-
-        return bytes(final)
+        return self._unpad(decrypted)
 
     def aes_encrypt(self, raw, key = None):
         # If the key is not set, then use the data_key from the access_token that comes from the current session
-        if not key:
-            key = self.data_key()
-
-        # Make sure to pad the data
-        self._pad(raw)
-
-        # Break up the data into blockSize sized blocks
-        blocks = [raw[i:i+self.blockSize] for i in range(0, len(raw), self.blockSize)]
-        final = bytearray([])
-
-        # Encrypt each block with a new Cipher. There doesn't seem to be a reset in Python for the Cipher object
-        for block in blocks:
-            cipher = AES.new(key, AES.MODE_CBC, INITIALIZATION_VECTOR)
-            encrypted = cipher.encrypt(bytes(block))
-            final.extend(encrypted)
-
-        return final
+        return bytearray(self._cipher(key).encrypt(self._pad(raw)))
 
     def _pad(self, s):
         pad = self.blockSize - (len(s) % self.blockSize)
-        s.extend([pad] * pad)
+        return bytes(s) + bytes([pad] * pad)
 
     def _unpad(self, s):
         return s[:-s[-1]]
@@ -96,6 +91,9 @@ class security:
         """
         This is just horrible...
         """
+        if self._data_key is not None:
+            return self._data_key
+
         # MD5 sum, yay
         m = hashlib.md5()
         # Hash the appKey
@@ -103,7 +101,5 @@ class security:
         # Use only half the HEX output of the hash
         key_hash = m.hexdigest().encode('ascii')[0:16]
         # Decrypt the access token with that weird key
-        key = self.aes_decrypt(bytearray.fromhex(self.accessToken), key_hash)
-        return key
-
-
+        self._data_key = self.aes_decrypt(bytearray.fromhex(self.accessToken), key_hash)
+        return self._data_key
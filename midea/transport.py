@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+
+import aiohttp   # pip3 install aiohttp
+
+from midea import metrics
+
+VERSION = '0.1.7'
+
+_request_seconds = metrics.histogram('midea_api_request_seconds', 'Time taken by midea cloud api requests',
+                                     ('endpoint',))
+
+
+class request_timing:
+    """
+    Running timing figures for one endpoint.  All times in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, elapsed, ok=True):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total += elapsed
+        self.last = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean': self.mean,
+            'max': self.max,
+            'last': self.last,
+        }
+
+
+class transport:
+    """
+    HTTP transport for the cloud API.  Holds one pool of keep-alive connections for the life of the cloud instance,
+    so only the first request pays for the DNS lookup, TCP connect and TLS handshake.
+
+    If nothing has been sent for `ping_secs`, a HEAD is sent to the server to keep a connection open, so a request
+    the user is waiting on doesn't find the pool gone cold.  Set `ping_secs` to 0 to disable it.
+    """
+
+    def __init__(self, base_url, pool_size=10, keepalive_secs=120, ping_secs=50, timeout_secs=30):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.keepalive_secs = keepalive_secs
+        self.ping_secs = ping_secs
+        self.timeout_secs = timeout_secs
+
+        self._http = None
+        self._ping_task = None
+        self._last_used = 0.0
+        self._timings = {}  # endpoint -> request_timing
+
+    def _session(self):
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_secs,
+                                             ttl_dns_cache=self.keepalive_secs)
+            self._http = aiohttp.ClientSession(connector=connector,
+                                               timeout=aiohttp.ClientTimeout(total=self.timeout_secs))
+        if self.ping_secs and (self._ping_task is None or self._ping_task.done()):
+            self._last_used = time.monotonic()
+            self._ping_task = asyncio.ensure_future(self._ping_loop())
+        return self._http
+
+    async def post(self, endpoint, data):
+        """
+        POSTs the form `data` to `endpoint` (relative to base_url) and returns the response text.
+        """
+        http = self._session()
+        start = time.monotonic()
+        ok = False
+        try:
+            async with http.post(self.base_url + endpoint, data=data) as r:
+                text = await r.text()
+            ok = True
+            return text
+        finally:
+            self._last_used = time.monotonic()
+            self._timings.setdefault(endpoint, request_timing()).add(self._last_used - start, ok)
+            _request_seconds.observe(self._last_used - start, endpoint)
+
+    async def _ping_loop(self):
+        while True:
+            idle = time.monotonic() - self._last_used
+            if idle < self.ping_secs:
+                await asyncio.sleep(self.ping_secs - idle)
+                continue
+
+            start = time.monotonic()
+            try:
+                async with self._http.head(self.base_url) as r:
+                    await r.read()
+                logging.debug('Keep-alive ping took {:.3f}s'.format(time.monotonic() - start))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug('Keep-alive ping failed: {}'.format(repr(e)))
+            self._last_used = time.monotonic()
+
+    def stats(self):
+        """
+        Per-endpoint timings, e.g. {'appliance/transparent/send': {'count': 10, 'errors': 0, 'mean': 0.21, ...}}
+        """
+        return {k: v.as_dict() for k, v in self._timings.items()}
+
+    async def close(self):
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+            self._ping_task = None
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
@@ -14,8 +14,100 @@ AIRCONS = ('Aircon1', 'Aircon2')
 # Base url of your openhab.  Assumes that no auth is required.
 OH_URL = 'http://openhab:8080'      # url of your openhab server
 
+# Give up on a request to openhab's rest api after this many seconds
+OH_TIMEOUT_SECS = 10
+
 # How often do we poll the midea api for changes (in seconds)
 # If you'll _only_ be changing the ac settings via openhab, then you can set this to something really
 # really large (say 365*24*60*60).
 MIDEA_POLL_FREQ_SECS = 900
 
+# Aircons that are switched off are polled this often instead (never more often than MIDEA_POLL_FREQ_SECS)
+MIDEA_IDLE_POLL_SECS = 3600
+
+# After we've sent a change to an aircon, poll it every MIDEA_CONFIRM_POLL_SECS for MIDEA_CONFIRM_WINDOW_SECS.
+# A window of 0 turns this off.
+MIDEA_CONFIRM_POLL_SECS = 15
+MIDEA_CONFIRM_WINDOW_SECS = 60
+
+# Max number of connections kept open to the midea cloud
+MIDEA_POOL_SIZE = 10
+
+# If nothing has been sent to the midea cloud for this long (in seconds), ping it so the connection doesn't go cold.
+# 0 disables the ping.
+MIDEA_KEEPALIVE_PING_SECS = 50
+
+# The midea login is saved here (readable only by the user we run as), so restarts don't have to log in again.
+# Set to None to log in from scratch every time.
+MIDEA_SESSION_CACHE = '.midea_session.json'
+
+# Talk to some other midea cloud, e.g. bench/fake_cloud.py for testing.  None means the real one.
+MIDEA_SERVER_URL = None
+
+# When a change comes in from openhab, wait this long (in seconds) for any other changes to the same aircon, and send
+# them all to midea together.
+MIDEA_APPLY_WINDOW_SECS = 0.5
+
+# Before sending a change to midea we normally refresh the aircon first, so we don't overwrite anything that was
+# changed elsewhere (e.g. with the remote).  If we've heard from the aircon within this many seconds, trust what we
+# have and skip the refresh.  0 always refreshes.
+MIDEA_STATE_MAX_AGE_SECS = 60
+
+# Max number of aircons polled at the same time
+MIDEA_POLL_WORKERS = 8
+
+# How long (in seconds) a poll of all the aircons is allowed to take.  Any that haven't answered by then are logged
+# and left to finish in the background, and skipped next time if they still haven't.
+MIDEA_POLL_BUDGET_SECS = 60
+
+# Number of threads sending updates to openhab
+OH_WRITE_WORKERS = 2
+
+# If nothing at all comes down the openhab event stream for this many seconds, assume it has died and reconnect.
+# openhab 3 sends a heartbeat every 10 seconds; openhab 2 doesn't, so on a quiet oh2 this just reconnects (and
+# re-reads our items) every so often.  0 disables it.
+SSE_STALL_SECS = 60
+
+# After the event stream fails, wait a random time of up to this many seconds before reconnecting, doubling (up to the
+# max) each time it fails again.
+SSE_RECONNECT_MIN_SECS = 1
+SSE_RECONNECT_MAX_SECS = 60
+
+# Serve prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics.  None turns it off.
+METRICS_PORT = None
+METRICS_HOST = '127.0.0.1'
+
+# With lots of aircons (or more than one midea account), run this many worker processes, each with its own midea
+# session, polling its share of AIRCONS.  A worker that dies is restarted, after a delay that doubles (from
+# WORKER_RESTART_MIN_SECS up to WORKER_RESTART_MAX_SECS) if it keeps dying.  Each worker keeps its session in
+# MIDEA_SESSION_CACHE with its number added (.midea_session.0.json, ...) and serves metrics on METRICS_PORT + its
+# number.  1 runs everything in this process, as before.
+WORKERS = 1
+WORKER_RESTART_MIN_SECS = 1
+WORKER_RESTART_MAX_SECS = 300
+
+# More than one midea account: a list of settings to use instead of the ones above, for each account, e.g.
+#   ACCOUNTS = [
+#       {'EMAIL': 'me@example.com', 'PASSWORD': '...', 'AIRCONS': ('Lounge', 'Bedroom')},
+#       {'EMAIL': 'mum@example.com', 'PASSWORD': '...', 'AIRCONS': ('Kitchen',)},
+#   ]
+# Each account gets (up to) WORKERS workers of its own.
+ACCOUNTS = None
+
+# Don't send midea more than MIDEA_RATE_LIMIT requests a second on average, with bursts of up to MIDEA_RATE_BURST, so
+# we don't provoke it into "system error"s.  When requests do have to wait, changes from openhab go first, then polls
+# checking a change took, then routine polls, then the device list.  None turns the limit off.
+MIDEA_RATE_LIMIT = 5
+MIDEA_RATE_BURST = 10
+
+# Once an aircon is found to be offline, nothing is sent to it (changes from openhab fail straight away) for
+# MIDEA_OFFLINE_RETRY_SECS, then it's polled again, waiting twice as long each time it's still offline, up to
+# MIDEA_OFFLINE_RETRY_MAX_SECS.  These are the only settings for offline aircons: the poll is timed to be the first
+# thing let through to it.
+MIDEA_OFFLINE_RETRY_SECS = 15
+MIDEA_OFFLINE_RETRY_MAX_SECS = 300
+
+# The device list is fetched again in the background every MIDEA_DEVICE_LIST_TTL_SECS, and when an aircon is offline
+# if it's more than MIDEA_DEVICE_LIST_MIN_AGE_SECS old.
+MIDEA_DEVICE_LIST_TTL_SECS = 10 * 60
+MIDEA_DEVICE_LIST_MIN_AGE_SECS = 60